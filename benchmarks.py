@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+
+# Copyright 2012 Russell Davies. Licensed under the Apache License, v2.0.
+
+"""Benchmarks for cliresms
+
+Run with the name of one or more benchmarks (all of them by default), e.g.
+
+    python benchmarks.py startup split_message
+
+Everything runs offline: sends go to the stub carriers used by --dry-run and
+O2's responses are read from the recordings in fixtures/. Each measurement
+reports the latency of one call, the throughput in items (characters,
+numbers, bytes or recipients) per second and, where tracemalloc is
+available, the peak memory allocated by one call.
+"""
+
+from __future__ import print_function
+import argparse
+import itertools
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+import cliresms
+
+here = os.path.abspath(os.path.dirname(__file__))
+fixtures = os.path.join(here, 'fixtures')
+timer = getattr(time, 'perf_counter', time.time)
+# Where the accounts keep their sessions while benchmarking
+state_dir = None
+accounts = itertools.count()
+
+
+def run_cli(args, env=None):
+    """Run cliresms in a new interpreter, returning the seconds taken"""
+    return run_python('import sys, cliresms; sys.argv = %r; cliresms.main()'
+            % (['cliresms'] + args), env)
+
+def run_python(code, env=None):
+    """Run code in a new interpreter, returning the seconds taken"""
+    start = timer()
+    with open(os.devnull, 'w') as devnull:
+        subprocess.call([sys.executable, '-c', code], cwd=here, env=env,
+                stdout=devnull, stderr=devnull)
+    return timer() - start
+
+def measure(func, repeat):
+    """Time repeat calls of func, returning the timings and the peak memory
+    allocated by one more call (None without tracemalloc)"""
+    timings = []
+    for i in range(repeat):
+        start = timer()
+        func()
+        timings.append(timer() - start)
+    if not tracemalloc:
+        return timings, None
+    tracemalloc.start()
+    try:
+        func()
+        return timings, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def report(name, timings, items=None, peak=None):
+    timings = sorted(timings)
+    p50 = cliresms.percentile(timings, 50)
+    line = '%-34s min %9.2fms  p50 %9.2fms  p95 %9.2fms' % (name,
+            timings[0] * 1000, p50 * 1000,
+            cliresms.percentile(timings, 95) * 1000)
+    if items:
+        line += '  %12.0f/s' % (items / p50)
+    if peak is not None:
+        line += '  peak %9.1fKB' % (peak / 1024.0)
+    print(line)
+
+def sizes(limit, start=1):
+    """Powers of ten from start up to limit"""
+    size = start
+    while size <= limit:
+        yield size
+        size *= 10
+
+def numbers(count):
+    """Distinct valid mobile numbers, written in a mix of formats"""
+    formats = ('086%07d', '+35386%07d', '086 %03d %04d')
+    for i in range(count):
+        if i % 3 == 2:
+            yield formats[2] % divmod(i % 10 ** 7, 10000)
+        else:
+            yield formats[i % 3] % (i % 10 ** 7)
+
+class quiet(object):
+    """Discard anything printed within the block"""
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+
+    def __exit__(self, *exc_info):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+def get_account(carrier_name):
+    """Return an account with its sessions kept in the temporary directory"""
+    return cliresms.get_carriers()[carrier_name]('bench', 'bench',
+            os.path.join(state_dir, '%s-%d' % (carrier_name, next(accounts))))
+
+def bench_startup(args):
+    """Cold start latency of the command line"""
+    env = dict(os.environ)
+    # Time with compiled bytecode, as an installed copy would run
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    run_cli(['--version'], env)
+
+    repeat = args.repeat
+    report('python (no cliresms)', [run_python('pass', env)
+                                    for i in range(repeat)])
+    for cli_args in (['--version'], ['--help']):
+        report('cliresms %s' % ' '.join(cli_args), [run_cli(cli_args, env)
+                                                    for i in range(repeat)])
+
+    # A whole send against the stub carriers, with an empty home directory
+    # so the user's configuration isn't used
+    home = tempfile.mkdtemp()
+    try:
+        env['HOME'] = home
+        cli_args = ['--dry-run', '-C', 'meteor', '-m', 'Hi', '0865551234']
+        report('cliresms --dry-run', [run_cli(cli_args, env)
+                                      for i in range(repeat)])
+    finally:
+        shutil.rmtree(home)
+
+    # Show which imports take longest, as python -X importtime does
+    if sys.version_info >= (3, 7):
+        output = subprocess.Popen([sys.executable, '-X', 'importtime', '-c',
+                'import cliresms'], cwd=here, env=env,
+                stderr=subprocess.PIPE).communicate()[1].decode('utf-8')
+        imports = []
+        for line in output.splitlines()[1:]:
+            fields = line.split('|')
+            imports.append((int(fields[1]), fields[2].rstrip()))
+        print('Slowest imports (cumulative):')
+        for cumulative, name in sorted(imports, reverse=True)[:10]:
+            print('  %8.2fms %s' % (cumulative / 1000.0, name))
+
+def bench_split_message(args):
+    """Splitting messages of increasing length into texts"""
+    for length in sizes(100000, 10):
+        message = ('Pints at eight? ' * (length // 16 + 1))[:length]
+        with quiet():
+            timings, peak = measure(lambda: cliresms.split_message(message),
+                                    args.repeat)
+        report('%d chars' % length, timings, length, peak)
+
+def bench_validate_number(args):
+    """Validating and normalising numbers for each carrier"""
+    for carrier_name in sorted(cliresms.get_carriers()):
+        account = get_account(carrier_name)
+        for count in sizes(args.max_recipients):
+            recipients = list(numbers(count))
+            timings, peak = measure(lambda: [account.validate_number(number)
+                                             for number in recipients],
+                                    args.repeat)
+            report('%s %d numbers' % (carrier_name, count), timings, count,
+                   peak)
+
+def legacy_parse_json(content):
+    """The original O2Account.parse_json, which strips comments one
+    at a time and so is quadratic in their number, for comparison"""
+    comment_re = re.compile(
+            '(^)?[^\\S\n]*/(?:\\*(.*?)\\*/[^\\S\n]*|/[^\n]*)($)?',
+            re.DOTALL | re.MULTILINE
+    )
+    match = comment_re.search(content)
+    while match:
+        content = content[:match.start()] + content[match.end():]
+        match = comment_re.search(content)
+    content = re.sub('\'', '"', content)
+    content = re.sub(' \\* \\d*,', ',', content)
+    def quote_wrap(match):
+        offset = match.start()
+        beginning = match.group()[match.start() - offset:match.start(1) - offset]
+        ending = match.group()[match.start(1) - offset + len(match.group(1)):]
+        return beginning + '"' + match.group(1) + '"' + ending
+    quote_re = re.compile(r'[{,][\n\r\t]*\s*(\w+)\s*:')
+    return json.loads(quote_re.sub(quote_wrap, content))
+
+def bench_parse_json(args):
+    """Cleaning up and parsing O2's JavaScript responses"""
+    account = get_account('o2')
+    parsers = (('', account.parse_json), ('legacy ', legacy_parse_json))
+    for name in sorted(os.listdir(fixtures)):
+        if not name.startswith('o2_'):
+            continue
+        with open(os.path.join(fixtures, name)) as f:
+            content = f.read()
+        if account.parse_json(content) != legacy_parse_json(content):
+            print('%s: parsed differently by the legacy parser' % name)
+        for prefix, parse in parsers:
+            timings, peak = measure(lambda: parse(content), args.repeat)
+            report(prefix + name, timings, len(content), peak)
+
+    # Larger responses, with more fields and comments, show how the parsing
+    # scales
+    with open(os.path.join(fixtures, 'o2_evaluate.txt')) as f:
+        body = f.read().strip().rstrip('}')
+    for count in sizes(100000):
+        fields = ''.join('\t/* field %d */\n\tfield%d : %d, // value\n'
+                         % (i, i, i) for i in range(count))
+        content = body.replace('{', '{\n' + fields, 1) + '}'
+        for prefix, parse in parsers:
+            # The legacy parser takes minutes beyond a few thousand comments
+            if prefix and count > 1000:
+                continue
+            timings, peak = measure(lambda: parse(content), args.repeat)
+            report('%s%d extra fields (%dKB)' % (prefix, count,
+                   len(content) // 1024), timings, len(content), peak)
+
+def bench_send(args):
+    """Whole sends to the stub carriers, from validation to the last request"""
+    cliresms.StubCarrierHandler.stub_texts = 10 ** 9
+    with quiet():
+        cliresms.start_stub_carriers()
+    for carrier_name in sorted(cliresms.get_carriers()):
+        account = get_account(carrier_name)
+        for count in sizes(args.max_recipients):
+            recipients = list(numbers(count))
+            send = lambda: cliresms.send_message(account, iter(recipients),
+                                                 'Pints at eight?')
+            # Each repeat sends to every recipient, so cap the total
+            repeat = max(1, min(args.repeat, args.max_recipients // count))
+            with quiet():
+                timings, peak = measure(send, repeat)
+            report('%s %d recipients' % (carrier_name, count), timings, count,
+                   peak)
+
+benchmarks = {
+    'startup': bench_startup,
+    'split_message': bench_split_message,
+    'validate_number': bench_validate_number,
+    'parse_json': bench_parse_json,
+    'send': bench_send,
+}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('benchmarks', nargs='*', metavar='NAME',
+            help='Benchmarks to run: %s' % ', '.join(sorted(benchmarks)))
+    parser.add_argument('-r', '--repeat', type=int, default=20,
+            help='Number of times to repeat each measurement')
+    parser.add_argument('-n', '--max-recipients', type=int, default=100000,
+            help='Largest number of recipients to send to or validate')
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in benchmarks:
+            parser.error('unknown benchmark %s' % name)
+    global state_dir
+    state_dir = tempfile.mkdtemp(prefix='cliresms-bench-')
+    try:
+        for name in args.benchmarks or sorted(benchmarks):
+            print('== %s: %s' % (name, benchmarks[name].__doc__))
+            benchmarks[name](args)
+    finally:
+        shutil.rmtree(state_dir, True)
+
+if __name__ == "__main__":
+    sys.exit(main())
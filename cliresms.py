@@ -4,36 +4,50 @@
 
 from __future__ import print_function
 import argparse
-try:
-    from http import cookiejar
-except ImportError:
-    import cookielib as cookiejar
-import datetime
+import codecs
+import collections
+import errno
 import getpass
+import heapq
+import itertools
 import json
 import logging
 import os
 import re
 import signal
+import socket
 import sys
+import threading
 import time
 try:
-    from urllib.parse import urlencode
-    from urllib.request import urlopen, build_opener, install_opener, Request, HTTPCookieProcessor
-    from urllib.error import URLError, HTTPError
+    from urllib.parse import urlencode, parse_qs, quote
+    from queue import Queue
+    import socketserver
+except ImportError:
+    from urllib import urlencode, quote
+    from urlparse import parse_qs
+    from Queue import Queue
+    import SocketServer as socketserver
+try:
+    from StringIO import StringIO
 except ImportError:
-    from urllib import urlencode
-    from urllib2 import urlopen, build_opener, install_opener, Request, HTTPCookieProcessor
-    from urllib2 import URLError, HTTPError
+    from io import StringIO
 # Python 2-3 compatibility hack
 try:
     raw_input
 except NameError:
     raw_input = input
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
 
 __version__ = '0.2.0'
 __conf_file__ = os.path.join(os.path.expanduser("~"), '.cliresms.conf')
 __cookie_file__ = os.path.join(os.path.expanduser("~"), '.cliresms.cookie')
+__quota_file__ = os.path.join(os.path.expanduser("~"), '.cliresms.quota')
+__sent_file__ = os.path.join(os.path.expanduser("~"), '.cliresms.sent')
+__queue_file__ = os.path.join(os.path.expanduser("~"), '.cliresms.queue')
 
 log = logging.getLogger()
 
@@ -43,9 +57,74 @@ split = True
 carrier = None
 message = None
 aliases = {}
+alias_names = {}
 recipients = []
 conf_file = None
-get_carriers = lambda: dict((cls.carrier_name(), cls) for cls in Account.__subclasses__())
+chunk_size = 100
+accounts = []
+results_lock = threading.Lock()
+sessions = {}
+sessions_lock = threading.Lock()
+rate_limits = {}
+# Matches a line in the form: alias name +1234 foo 5789
+# There can be variable whitespace between the tokens and
+# the numbers can be in international or local form
+alias_re = re.compile(r'^\s*alias\s+([\w\.\-\_]+)\s+([\w\s\+\.-]+)\s*')
+alias_separators_re = re.compile(r'[\.-]')
+alias_contact_re = re.compile(r'(\+?\d+|\w+)')
+number_re = re.compile(r'^\+?\d+$')
+interval_re = re.compile(r'^(\d+(?:\.\d*)?)([smhd]?)$')
+interval_units = {'': 1, 's': 1, 'm': 60, 'h': 3600, 'd': 86400}
+carriers = {}
+# The GSM 03.38 alphabet, in which a text can carry 160 characters (153 per
+# part when concatenated); any other character means UCS-2 and 70 (or 67).
+# The extension characters are sent escaped so take two places.
+gsm_chars = frozenset(u'@\xa3$\xa5\xe8\xe9\xf9\xec\xf2\xc7\n\xd8\xf8\r\xc5\xe5'
+        u'\u0394_\u03a6\u0393\u039b\u03a9\u03a0\u03a8\u03a3\u0398\u039e\xc6\xe6'
+        u'\xdf\xc9 !"#\xa4%&\'()*+,-./0123456789:;<=>?\xa1ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+        u'\xc4\xd6\xd1\xdc\xa7\xbfabcdefghijklmnopqrstuvwxyz\xe4\xf6\xf1\xfc\xe0'
+        u'^{}\\[~]|\u20ac\f')
+gsm_extension_re = re.compile(u'[\\^{}\\\\\\[~\\]|\u20ac\f]')
+# Characters outside the Basic Multilingual Plane take two UCS-2 places
+astral_re = re.compile(u'[\U00010000-\U0010ffff]' if sys.maxunicode > 0xffff
+        else u'[\ud800-\udbff][\udc00-\udfff]')
+word_re = re.compile(r'\s*\S+')
+field_re = re.compile(r'\{(\w+)\}')
+
+
+def get_carriers():
+    """Return the Account class for each carrier name"""
+    if not carriers:
+        carriers.update((cls.carrier_name(), cls)
+                        for cls in Account.__subclasses__())
+    return carriers
+
+def load_http():
+    """Import the modules used to talk to the carriers
+
+    They take longer to import than everything else put together, so are
+    left until needed to keep --help, --version and the like quick.
+    """
+    global cookiejar, HTTPConnection, HTTPSConnection, HTTPException
+    global BadStatusLine
+    global build_opener, Request, HTTPCookieProcessor, addinfourl
+    global URLError, HTTPError
+    if 'HTTPError' in globals():
+        return
+    try:
+        from http import cookiejar
+        from http.client import HTTPConnection, HTTPSConnection, HTTPException
+        from http.client import BadStatusLine
+        from urllib.request import build_opener, Request, HTTPCookieProcessor
+        from urllib.response import addinfourl
+        from urllib.error import URLError, HTTPError
+    except ImportError:
+        import cookielib as cookiejar
+        from httplib import HTTPConnection, HTTPSConnection, HTTPException
+        from httplib import BadStatusLine
+        from urllib import addinfourl
+        from urllib2 import build_opener, Request, HTTPCookieProcessor
+        from urllib2 import URLError, HTTPError
 
 
 def main():
@@ -60,9 +139,15 @@ def main():
     except IOError as err:
         print(err)
         return err.errno
+    # Only serving, piping or resuming a queue go without recipients, so
+    # fail before prompting for anything
+    if not (args.recipients or args.recipients_file or args.serve or
+            args.pipe or args.queue or args.schedules or args.cancel_schedule):
+        cli_parser.error("no recipients given")
 
     loglevel = logging.WARN - (args.verbose * 10)
     logging.basicConfig(level=loglevel)
+    load_http()
 
     # Read supplied conf file otherwise try to load default conf file (if exists)
     global conf_file
@@ -77,7 +162,53 @@ def main():
         read_config(conf_file)
 
     # Override any conf file loaded values with cli args
-    global username, password, carrier, split
+    global username, password, carrier, split, chunk_size
+    if not split and args.split_messages:
+        split = True
+    if args.chunk_size:
+        chunk_size = args.chunk_size
+    if args.timeout:
+        connection_pool.timeout = args.timeout
+    if args.pipe:
+        # The results are written to stdout, so anything else printed goes
+        # to stderr
+        args.output, sys.stdout = sys.stdout, sys.stderr
+    if args.dry_run and args.queue:
+        # Whatever was queued would be sent for real by a later run
+        cli_parser.error("--queue can't be used with --dry-run")
+    if args.dry_run:
+        start_stub_carriers(args.stub_latency, args.stub_failures)
+        username = username or 'dryrun'
+        password = password or 'dryrun'
+    sent_log.skip = args.skip_sent
+    metrics.trace = args.trace
+
+    if args.template and (args.pool or args.queue or args.serve or
+            args.pipe):
+        cli_parser.error("--template can't be used with --pool, --queue, "
+                "--serve or --pipe")
+    if args.queue and (args.pool or args.serve or args.pipe):
+        cli_parser.error("--queue can't be used with --pool, --serve or "
+                "--pipe")
+    if (args.at or args.every) and (args.pool or args.serve or args.pipe or
+            args.template):
+        cli_parser.error("--at and --every can't be used with --pool, "
+                "--serve, --pipe or --template")
+    if args.at or args.every or args.schedules or args.cancel_schedule:
+        # Scheduled sends are kept in a queue until they're due
+        args.queue = args.queue or __queue_file__
+    if args.schedules or args.cancel_schedule:
+        return manage_schedules(args)
+
+    if args.pool:
+        return send_with_pool(cli_parser, args)
+
+    if args.pipe and not ((args.username or username) and
+            (args.password or password) and (args.carrier or carrier)):
+        # Nothing can be prompted for as stdin is the messages to send
+        log.error("The username, password and carrier must be given as "
+                "options or in the config file with --pipe")
+        return 1
     if args.username:
         username = args.username
     else:
@@ -99,68 +230,311 @@ def main():
                 ', '.join(carrier_names))
         return 1
 
-    if not split and args.split_messages:
-        split = True
+    # The same session is used if the send has to be retried
+    account = get_account(carrier, username, password)
+
+    if args.serve:
+        return serve(args.serve, lambda recipients, message, results:
+                send_message(account, recipients, message, results, sent_log))
+    if args.pipe:
+        return pipe(lambda recipients, message, results:
+                send_message(account, recipients, message, results, sent_log),
+                args.output)
+
+    if args.queue:
+        return send_with_queue(cli_parser, args, account)
 
-    # Build a list of numbers from aliases
     try:
-        process_recipients(args.recipients)
+        pending, message = prepare_send(cli_parser, args)
     except ValueError:
         return 1
 
-    message = get_message(args.message)
-
     # Send SMS
+    status = None
     while True:
         try:
-            send_message(recipients, message)
+            if args.template:
+                send_templated(account, pending, message, args.results_file,
+                        sent_log)
+            else:
+                send_message(account, pending, message, args.results_file,
+                        sent_log)
             break
         except (HTTPError, URLError, LoginException) as e:
             e.message = {HTTPError: "Server could not fulfill the request.",
-                 URLError: "Server unreachable."}.get(type(e), e.message)
+                 URLError: "Server unreachable."}.get(type(e), str(e))
             log.error(e.message)
-            choice = raw_input("Retry send? [Y/n] ").lower()
+            # Nobody can be asked when stdin is the recipients
+            choice = 'n'
+            if args.recipients_file is not sys.stdin:
+                try:
+                    choice = raw_input("Retry send? [Y/n] ").lower()
+                except EOFError:
+                    pass
             if choice in ('y', ''):
+                # Resume with the chunk that was in flight, if any
+                pending = itertools.chain(getattr(e, 'unsent', []), pending)
                 continue
-            else:
-                break
+            # Record everyone left out, the chunk in flight first unless its
+            # outcome has been recorded already
+            unsent = pending
+            if not getattr(e, 'recorded', False):
+                unsent = itertools.chain(getattr(e, 'unsent', []), pending)
+            if args.template:
+                unsent = (recipient for recipient, fields in unsent)
+            for chunk in chunked(unsent, chunk_size):
+                write_results(args.results_file, chunk, 'unsent', e.message)
+            status = 1
+            break
 
     # Save any unknown numbers to config file
-    save_aliases()
+    if not args.dry_run:
+        save_aliases()
+    report_stats(args)
+    return status
+
+def report_stats(args):
+    """Log how connections and rate limits were used, and report metrics"""
+    log.info(connection_pool.stats())
+    if rate_limits:
+        log.info(rate_stats())
+    if args.stats:
+        print(metrics.summary())
+    if args.metrics:
+        with open(args.metrics, 'w') as f:
+            f.write(metrics.prometheus())
+
+def prepare_send(cli_parser, args):
+    """Return the stream of recipients and the message to send to them"""
+    if not args.recipients and not args.recipients_file:
+        cli_parser.error("no recipients given")
+    if args.recipients_file is sys.stdin and not args.message:
+        cli_parser.error("the message must be given with -m when reading "
+                "recipients from stdin")
+
+    # Build a list of numbers from aliases
+    process_recipients(args.recipients)
+
+    message = get_message(args.message)
+    if not message.strip():
+        log.error("The message is empty")
+        raise ValueError("The message is empty")
+
+    # Numbers from the recipients file are streamed rather than collected
+    if args.template:
+        # Each recipient comes with the fields to fill in for them
+        pending = recipient_fields(args.recipients)
+        if args.recipients_file:
+            pending = itertools.chain(pending,
+                    read_contacts(args.recipients_file))
+        return pending, message
+    pending = iter(recipients)
+    if args.recipients_file:
+        pending = itertools.chain(pending, read_recipients(args.recipients_file))
+    return pending, message
+
+def send_with_pool(cli_parser, args):
+    """Send using every account defined in the config file"""
+    if not accounts:
+        log.error("No accounts defined in the config file, add lines of the "
+                "form: account <carrier> <username> <password>")
+        return 1
+    carrier_names = get_carriers().keys()
+    for account_carrier, account_username, account_password in accounts:
+        if account_carrier not in carrier_names:
+            log.error("Invalid carrier %s for account %s. Specify one of: %s",
+                    account_carrier, account_username, ', '.join(carrier_names))
+            return 1
+
+    if not (args.serve or args.pipe):
+        try:
+            pending, message = prepare_send(cli_parser, args)
+        except ValueError:
+            return 1
+    pool = login_pool(accounts)
+    if not pool:
+        log.error("None of the accounts could be used")
+        return 1
+
+    if args.serve:
+        return serve(args.serve, lambda recipients, message, results:
+                send_pool(pool, recipients, message, results, sent_log))
+    if args.pipe:
+        return pipe(lambda recipients, message, results:
+                send_pool(pool, recipients, message, results, sent_log),
+                args.output)
+
+    unsent = send_pool(pool, pending, message, args.results_file, sent_log)
+    if not args.dry_run:
+        save_aliases()
+    report_stats(args)
+    if unsent:
+        log.error("%d recipients could not be sent to", unsent)
+        return 1
+
+def send_with_queue(cli_parser, args, account):
+    """Queue the message and send everything in the queue as it becomes due
+
+    Without any recipients this carries on with whatever was left queued by an
+    earlier run, including the schedules, and with --every it sends the new
+    schedule. While there are schedules to send this keeps running, staying
+    logged in, until it's interrupted. Other runs leave the schedules be and
+    finish once what they queued has been sent.
+    """
+    queue = SendQueue(args.queue)
+    scheduling = args.every or not (args.recipients or args.recipients_file)
+    if args.recipients or args.recipients_file:
+        try:
+            pending, message = prepare_send(cli_parser, args)
+        except ValueError:
+            return 1
+        numbers = validate_recipients(account, pending, args.results_file)
+        parts = split_message(message, account.message_length)
+        if args.every:
+            queue.schedule(list(numbers), parts, args.at or time.time(),
+                    args.every)
+        else:
+            queue.add(numbers, parts, args.at or 0)
+        if args.at:
+            print("Scheduled for %s" % time.strftime('%Y-%m-%d %H:%M:%S',
+                    time.localtime(args.at)))
+
+    try:
+        send_queued(account, queue, args.results_file, scheduling)
+    except (HTTPError, URLError, LoginException) as err:
+        log.error(err)
+        print("Unsent texts are kept in %s, run again with --queue to resume"
+                % args.queue)
+        return 1
+    finally:
+        queue.close()
+    if not args.dry_run:
+        save_aliases()
+    report_stats(args)
+
+def manage_schedules(args):
+    """List the schedules in the queue, or cancel one of them"""
+    queue = SendQueue(args.queue)
+    try:
+        if args.cancel_schedule:
+            if not queue.cancel(args.cancel_schedule):
+                log.error("No schedule %d in %s", args.cancel_schedule,
+                        args.queue)
+                return 1
+            print("Cancelled schedule %d" % args.cancel_schedule)
+            return
+        for schedule_id, next_run, interval, recipients, parts in \
+                queue.schedules():
+            print("%d\t%s\tevery %s\t%d recipients\t%s" % (schedule_id,
+                    time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(next_run)),
+                    format_interval(interval), len(recipients), parts[0]))
+    finally:
+        queue.close()
+
+def format_interval(seconds):
+    for unit in 'dhm':
+        if seconds % interval_units[unit] == 0:
+            return '%d%s' % (seconds // interval_units[unit], unit)
+    return '%gs' % seconds
+
+def parse_time(value):
+    """Return the time value names in seconds since the epoch
+
+    value is either +INTERVAL from now, HH:MM the next time it comes round
+    or YYYY-MM-DD HH:MM.
+    """
+    import datetime
+    if value.startswith('+'):
+        return time.time() + parse_interval(value[1:])
+    now = datetime.datetime.now()
+    for format in ('%H:%M', '%H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d %H:%M:%S'):
+        try:
+            when = datetime.datetime.strptime(value, format)
+        except ValueError:
+            continue
+        if not format.startswith('%Y'):
+            when = datetime.datetime.combine(now.date(), when.time())
+            if when <= now:
+                when += datetime.timedelta(days=1)
+        return time.mktime(when.timetuple())
+    raise argparse.ArgumentTypeError("invalid time %r, give HH:MM, "
+            "YYYY-MM-DD HH:MM or +INTERVAL" % value)
+
+def parse_interval(value):
+    """Return the seconds in value, a number with an s, m, h or d suffix"""
+    match = interval_re.match(value)
+    if not match or not float(match.group(1)):
+        raise argparse.ArgumentTypeError("invalid interval %r, give e.g. "
+                "90s, 30m, 12h or 1d" % value)
+    return float(match.group(1)) * interval_units[match.group(2)]
 
 def read_config(file):
-    global username, password, carrier, split
+    """Load the settings and aliases in the config file
+
+    The parsed config is cached alongside the file and only parsed again when
+    the file changes, which saves parsing large address books on every run.
+    """
+    config = load_config_cache(file)
+    if config is None:
+        config = parse_config(file)
+        save_config_cache(file, config)
+    apply_config(config)
+
+def parse_config(file):
+    """Return the settings and aliases in the config file as a dict"""
+    config = {'accounts': [], 'rates': [], 'aliases': {}}
+    aliases = config['aliases']
 
     for line in map(lambda s: s.strip(), file.readlines()):
         # Skip over empty lines or comments
         if not line or line.startswith('#'):
             continue
         log.debug('Parsing line: %s', repr(line))
-        if 'username' in line:
-            username = line.split()[-1]
+        if line.startswith('account'):
+            # Matches a line in the form: account carrier username password
+            try:
+                account_carrier, account_username, account_password = line.split()[1:]
+            except ValueError:
+                log.error('Could not parse account line:\n%s', line)
+                raise
+            config['accounts'].append([account_carrier, account_username,
+                                       account_password])
+        elif line.startswith('rate'):
+            # Matches a line in the form: rate carrier[:username] per_minute [burst]
+            try:
+                name, per_minute = line.split()[1:3]
+                burst = int(line.split()[3]) if len(line.split()) > 3 else 1
+                if float(per_minute) <= 0 or burst < 1:
+                    raise ValueError('Rates and bursts must be positive')
+                config['rates'].append([name, float(per_minute), burst])
+            except (ValueError, IndexError):
+                log.error('Could not parse rate line:\n%s', line)
+                raise
+        elif 'username' in line:
+            config['username'] = line.split()[-1]
         elif 'password' in line:
-            password = line.split()[-1]
+            config['password'] = line.split()[-1]
         elif 'carrier' in line:
-            carrier = line.split()[-1]
+            config['carrier'] = line.split()[-1]
         elif 'nosplit' in line:
-            split = False
+            config['nosplit'] = True
+        elif 'pool_size' in line:
+            config['pool_size'] = int(line.split()[-1])
+        elif 'timeout' in line:
+            config['timeout'] = float(line.split()[-1])
         elif 'alias' in line:
             try:
-                # Matches a line in the form: alias name +1234 foo 5789
-                # There can be variable whitespace between the tokens and
-                # the numbers can be in international or local form
-                pattern = r'^\s*alias\s+([\w\.\-\_]+)\s+([\w\s\+\.-]+)\s*'
-                matches = re.search(pattern, line)
+                matches = alias_re.search(line)
                 alias_name = matches.group(1)
                 # Take out dots and dashes - easier to parse later
-                alias_contacts = re.sub(r'[\.-]', '', matches.group(2).strip())
+                alias_contacts = alias_separators_re.sub('', matches.group(2).strip())
                 # Must be a number (optionally starting with a '+') or word
-                alias_contacts = re.findall(r'(\+?\d+|\w+)', alias_contacts)
+                alias_contacts = alias_contact_re.findall(alias_contacts)
 
                 alias_numbers = []
                 for contact in alias_contacts:
                     # Check if valid number (with optional '+' at the start)
-                    if re.search(r'^\+?\d+$', contact):
+                    if number_re.search(contact):
                         number = contact
                         alias_numbers.append(number)
                     else:
@@ -173,7 +547,7 @@ def read_config(file):
                         except KeyError:
                             log.exception('Could not find %s, if you define '
                                 'aliases, you need to defined the referenced '
-                                'numbers first', name_or_number)
+                                'numbers first', contact)
                             log.info('So far, the known aliases are: %s', aliases)
                             raise
                 log.debug('Defining %s as %s', alias_name, alias_numbers)
@@ -184,6 +558,62 @@ def read_config(file):
         else:
             log.error('Could not parse line:\n%s', line)
 
+    # Index the aliases by number, for finding numbers without one
+    config['alias_names'] = {}
+    for alias_name, alias_numbers in aliases.items():
+        for number in alias_numbers:
+            config['alias_names'].setdefault(number, alias_name)
+    return config
+
+def apply_config(config):
+    global username, password, carrier, split
+    username = config.get('username', username)
+    password = config.get('password', password)
+    carrier = config.get('carrier', carrier)
+    if config.get('nosplit'):
+        split = False
+    connection_pool.size = config.get('pool_size', connection_pool.size)
+    connection_pool.timeout = config.get('timeout', connection_pool.timeout)
+    accounts.extend(tuple(account) for account in config['accounts'])
+    for name, per_minute, burst in config['rates']:
+        rate_limits[name] = TokenBucket(per_minute / 60, burst)
+    aliases.update(config['aliases'])
+    alias_names.update(config['alias_names'])
+
+def config_cache_file(file):
+    return '%s.cache' % os.path.abspath(file.name)
+
+def load_config_cache(file):
+    """Return the cached config if the config file hasn't changed since"""
+    try:
+        stat = os.fstat(file.fileno())
+        with open(config_cache_file(file)) as f:
+            cache = json.load(f)
+    except (AttributeError, IOError, OSError, ValueError):
+        return None
+    if cache.get('version') != __version__ or \
+            cache.get('mtime') != stat.st_mtime or \
+            cache.get('size') != stat.st_size:
+        return None
+    log.debug('Using cached config from %s', config_cache_file(file))
+    # Leave the file ready for new aliases to be appended, as after parsing
+    file.seek(0, os.SEEK_END)
+    return cache['config']
+
+def save_config_cache(file, config):
+    try:
+        stat = os.fstat(file.fileno())
+        # The cache holds the same passwords as the config file
+        fd = os.open(config_cache_file(file),
+                os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'version': __version__,
+                       'mtime': stat.st_mtime,
+                       'size': stat.st_size,
+                       'config': config,}, f)
+    except (AttributeError, IOError, OSError) as err:
+        log.debug('Could not cache config: %s', err)
+
 def get_message(message=None):
     if not message:
         # Prompt user for message text
@@ -202,34 +632,139 @@ def get_message(message=None):
     return message
 
 def split_message(message, length=160):
+    """Return the texts to send message as, of at most length characters
+
+    Long messages are split between words, and into texts that each fill a
+    whole number of SMS parts so that none are wasted. Raises ValueError if
+    there's nothing but whitespace to send.
+    """
+    if not message.strip():
+        raise ValueError("The message is empty")
     if len(message) > length:
         if split:
-            # Split message into multiple parts
-            messages = [message[i:i+length].strip()
-                        for i in range(0, len(message), length)]
-            print("Message length %d (%d max) will be sent in %d texts" %
-                    (len(message), length, len(messages)))
+            messages = wrap_message(message, text_capacity(message, length))
+            print("Message length %d (%d max) will be sent in %d texts, "
+                    "%d SMS parts" % (len(message), length, len(messages),
+                    sum(sms_parts(text) for text in messages)))
         else:
             log.warning('Message is %d chars, sending only first %d '
                         'chars', len(message), length)
             messages = [message[:length]]
     else:
         messages = [message[:length]]
+        parts = sms_parts(messages[0])
+        if parts > 1:
+            print("Message will be sent in %d SMS parts" % parts)
 
     message_length = sum([len(message) for message in messages])
     log.info('Messages (%d chars): %s', message_length, messages)
     return messages
 
+def is_gsm(text):
+    return gsm_chars.issuperset(text)
+
+def sms_units(text, gsm=None):
+    """Return the places text takes up in SMSs, in GSM-7 or UCS-2"""
+    if gsm is None:
+        gsm = is_gsm(text)
+    if gsm:
+        return len(text) + len(gsm_extension_re.findall(text))
+    # Narrow Python builds already count surrogate pairs as two
+    if sys.maxunicode > 0xffff:
+        return len(text) + len(astral_re.findall(text))
+    return len(text)
+
+def sms_parts(text):
+    """Return how many SMS parts text is sent as
+
+    A part of a concatenated SMS holds less, to make room for its header,
+    and escaped or surrogate pairs of places can't be split between parts.
+    """
+    gsm = is_gsm(text)
+    single, multi = (160, 153) if gsm else (70, 67)
+    units = sms_units(text, gsm)
+    if units <= single:
+        return 1
+    if units == len(text):
+        return -(-units // multi)
+    parts, used = 1, 0
+    for char in text:
+        size = sms_units(char, gsm)
+        if used + size > multi:
+            parts += 1
+            used = 0
+        used += size
+    return parts
+
+def text_capacity(message, length):
+    """Return the places to fill in each text when splitting message
+
+    This is the most whole SMS parts that fit in a text of length.
+    """
+    gsm = is_gsm(message)
+    single, multi = (160, 153) if gsm else (70, 67)
+    if sms_units(message, gsm) != len(message):
+        # Leave room for a part to end early rather than split a character
+        multi -= 1
+    if length >= 2 * multi:
+        return length // multi * multi
+    return min(length, single)
+
+def wrap_message(message, capacity):
+    """Split message between words into texts of at most capacity places
+
+    Words too long for a text of their own are split where they must be.
+    """
+    gsm = is_gsm(message)
+    if sms_units(message, gsm) == len(message):
+        units = len
+    else:
+        units = lambda text: sms_units(text, gsm)
+    texts = []
+    words, used = [], 0
+    for word in word_re.findall(message):
+        size = units(word)
+        if used + size > capacity and words:
+            texts.append(''.join(words))
+            word = word.lstrip()
+            words, used, size = [], 0, units(word)
+        while used + size > capacity:
+            # Fill a text with as much of the word as fits
+            taken = 0
+            for char in word:
+                used += units(char)
+                if used > capacity:
+                    break
+                taken += 1
+            texts.append(word[:taken])
+            word = word[taken:]
+            used, size = 0, units(word)
+        words.append(word)
+        used += size
+    if words:
+        texts.append(''.join(words))
+    return [text.strip() for text in texts]
+
 def process_recipients(arg_recipients):
     """Return a list of only numbers from alias definitions and any numbers entered"""
-    for recipient in arg_recipients:
+    # Groups may overlap, so only take each number once
+    seen = set(recipients)
+    for number in expand_recipients(arg_recipients):
+        if number not in seen:
+            seen.add(number)
+            recipients.append(number)
+
+def expand_recipients(names):
+    """Yield the numbers of each alias or number in names"""
+    for recipient in names:
         if recipient in aliases:
-            # an alias contains a list of numbers so extend rather than append
-            recipients.extend(aliases[recipient])
+            # an alias contains a list of numbers
+            for number in aliases[recipient]:
+                yield number
         else:
             # recipient is a number not alias
-            if re.search(r'\+?\d', recipient):
-                recipients.append(recipient)
+            if any(c.isdigit() for c in recipient):
+                yield recipient
             else:
                 log.error('Alias %s unknown', recipient)
                 log.error('Known aliases: %s',
@@ -237,13 +772,97 @@ def process_recipients(arg_recipients):
                         key=lambda x: x.lower())))
                 raise ValueError("Unknown alias: %s" % recipient)
 
+def read_recipients(file):
+    """Yield recipients one at a time from a file of numbers or aliases
+
+    Each line is a CSV record whose first field is the recipient, so both a
+    plain list of numbers and a contacts export can be used. Blank lines and
+    comments are skipped.
+    """
+    import csv
+    for record in csv.reader(file):
+        if not record or not record[0].strip():
+            continue
+        recipient = record[0].strip()
+        if recipient.startswith('#'):
+            continue
+        if recipient in aliases:
+            for number in aliases[recipient]:
+                yield number
+        else:
+            yield recipient
+
+def recipient_fields(names):
+    """Yield each number of each alias or number in names with its fields
+
+    The fields are the number and, for a number with an alias of its own,
+    its name.
+    """
+    names_by_number = dict((numbers[0], name) for name, numbers
+                           in aliases.items() if len(numbers) == 1)
+    for number in expand_recipients(names):
+        fields = {'number': number}
+        if number in names_by_number:
+            fields['name'] = names_by_number[number]
+        yield number, fields
+
+def read_contacts(file):
+    """Yield each recipient in a CSV file with a header, with their fields
+
+    The first column is the recipient, a number or alias, and each column is
+    a field named by the header, along with their number and, for an alias,
+    its name unless there's a name column.
+    """
+    import csv
+    reader = csv.reader(file)
+    header = None
+    for record in reader:
+        if not record or not record[0].strip() or record[0].startswith('#'):
+            continue
+        if header is None:
+            header = [name.strip() for name in record]
+            continue
+        fields = dict(zip(header, (value.strip() for value in record)))
+        recipient = record[0].strip()
+        if recipient in aliases:
+            fields.setdefault('name', recipient)
+        for number in aliases.get(recipient, [recipient]):
+            yield number, dict(fields, number=number)
+
+def render(template, fields):
+    """Fill in the {field}s of template, raising ValueError if one is missing"""
+    def field(match):
+        try:
+            return fields[match.group(1)]
+        except KeyError:
+            raise ValueError('No %s to fill in for %s' % (match.group(1),
+                    fields.get('number')))
+    return field_re.sub(field, template)
+
+def chunked(iterable, size):
+    """Yield lists of at most size items from iterable"""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+def write_results(results, recipients, status, detail=''):
+    """Record the outcome for each recipient in the results file"""
+    if not results:
+        return
+    with results_lock:
+        for recipient in recipients:
+            results.write('%s\t%s\t%s\n' % (recipient, status, detail))
+        results.flush()
+
 def save_aliases():
     if not conf_file: return
 
     new_aliases = {}
-    alias_nums = [num for sublist in aliases.values() for num in sublist]
     for num in recipients:
-        if num in alias_nums:
+        if num in alias_names:
             continue
         while True:
             entered = raw_input("Create alias for %s with this name: " % num).strip()
@@ -255,31 +874,61 @@ def save_aliases():
                 print("alias already exists")
                 continue
             new_aliases[entered] = num
+            alias_names[num] = entered
             break
     for name in new_aliases:
         try:
             conf_file.write("alias %s %s\n" % (name, new_aliases[name]))
         except:
-            print("Could not write aliases to configuration file %s" % os.path.abspath(f.name))
+            print("Could not write aliases to configuration file %s" % os.path.abspath(conf_file.name))
 
-def send_message(recipients, message):
-    global username, password, carrier
+def validate_recipients(account, recipients, results=None, seen=None):
+    """Yield each valid number once, recording any offending entries
 
-    account_type = get_carriers().get(carrier)
-    if not account_type:
-        log.error("Invalid carrier. Qutting...")
-        return
-    account = account_type(username, password)
-
-    # Validate all recipients and remove any offending entries
-    recipients_validated = []
+    Numbers already in seen, or yielded earlier, are skipped as duplicates,
+    however they are written.
+    """
+    if seen is None:
+        seen = set()
+    invalid = duplicates = 0
     for recipient in recipients:
         try:
-            recipients_validated.append(account.validate_number(recipient))
+            number = account.validate_number(recipient)
         except ValueError as err:
             log.warning(err)
-            recipients.remove(recipient)
-
+            write_results(results, [recipient], 'invalid', err)
+            invalid += 1
+            continue
+        canonical = account.canonical_number(number)
+        if canonical in seen:
+            write_results(results, [recipient], 'duplicate', canonical)
+            duplicates += 1
+            continue
+        seen.add(canonical)
+        yield number
+    if invalid or duplicates:
+        log.info('Skipped %d invalid and %d duplicate recipients', invalid,
+                duplicates)
+
+def get_account(carrier_name, username, password):
+    """Return the session for the account, independent of any others
+
+    Sessions are kept for the life of the process so that logging in again is
+    only needed when they expire, and each has its own cookie file, named
+    after the carrier and username, for use by later runs.
+    """
+    key = (carrier_name, username)
+    with sessions_lock:
+        account = sessions.get(key)
+        if not account or account.password != password:
+            cookie_file = '%s.%s.%s' % (__cookie_file__, carrier_name, username)
+            account = get_carriers()[carrier_name](username, password,
+                    cookie_file)
+            sessions[key] = account
+    return account
+
+def start_sending(account):
+    """Log in, making sure there are texts left to send"""
     if account.login():
         print("Logged in")
     else:
@@ -289,20 +938,428 @@ def send_message(recipients, message):
     elif account.texts_remaining < 0:
         raise LoginException("Could not determine number of texts remaining.")
 
+def send_message(account, recipients, message, results=None, sent_log=None):
+    start_sending(account)
+
     # Send message
     print("Sending message...", end='')
     sys.stdout.flush()
-    for message_part in split_message(message, account.message_length):
-        if account.send_message(recipients_validated, message_part):
-            account.texts_remaining -= len(recipients_validated)
+    messages = split_message(message, account.message_length)
+    # Recipients are validated and sent in bounded chunks so that arbitrarily
+    # long recipient streams are never held in memory at once
+    for chunk in chunked(validate_recipients(account, recipients, results),
+                         chunk_size):
+        if account.texts_remaining == 0:
+            err = LoginException("You don't have any more texts remaining.")
+            err.unsent = chunk
+            raise err
+        # Log in again if the session has expired
+        if not account.login():
+            err = LoginException("Could not login.")
+            err.unsent = chunk
+            raise err
+        try:
+            sent = send_parts(account, chunk, messages, sent_log)
+            if sent:
+                print("Message sent, %s texts remaining." % account.texts_remaining)
+        except (HTTPError, URLError, LoginException) as err:
+            write_results(results, chunk, 'error', err)
+            err.unsent = chunk
+            err.recorded = True
+            raise
+        if sent == len(messages):
+            write_results(results, chunk, 'sent')
+        else:
+            write_results(results, chunk, 'failed',
+                    '%d of %d parts sent' % (sent, len(messages)))
+
+def send_templated(account, recipients, template, results=None,
+                   sent_log=None):
+    """Send template, filled in with the fields of each recipient
+
+    recipients are pairs of a recipient and their fields. Messages are filled
+    in as they're needed, and those that come out the same are sent to their
+    recipients together, a chunk at a time.
+    """
+    start_sending(account)
+    print("Sending messages...", end='')
+    sys.stdout.flush()
+    seen = set()
+    # Recipients and their fields, by the message they're to be sent
+    groups = collections.OrderedDict()
+    buffered = 0
+
+    def flush(message):
+        group = groups.pop(message)
+        try:
+            numbers = list(validate_recipients(account,
+                    (recipient for recipient, fields in group), results, seen))
+            if not numbers:
+                return
+            if account.texts_remaining == 0:
+                raise LoginException("You don't have any more texts remaining.")
+            # Log in again if the session has expired
+            if not account.login():
+                raise LoginException("Could not login.")
+            messages = split_message(message, account.message_length)
+            sent = send_parts(account, numbers, messages, sent_log)
+        except (HTTPError, URLError, LoginException) as err:
+            # Whatever hasn't been sent is tried again on a retry
+            err.unsent = group + [pair for pairs in groups.values()
+                                  for pair in pairs]
+            raise
+        if sent == len(messages):
+            write_results(results, numbers, 'sent')
+        else:
+            write_results(results, numbers, 'failed',
+                    '%d of %d parts sent' % (sent, len(messages)))
+
+    for recipient, fields in recipients:
+        try:
+            message = render(template, fields)
+            if not message.strip():
+                raise ValueError('Nothing to send to %s' % recipient)
+        except ValueError as err:
+            log.warning(err)
+            write_results(results, [recipient], 'invalid', err)
+            continue
+        groups.setdefault(message, []).append((recipient, fields))
+        buffered += 1
+        # Send whole chunks as they fill up, and everything once too many
+        # recipients are waiting for others with the same message
+        if len(groups[message]) >= chunk_size:
+            buffered -= len(groups[message])
+            flush(message)
+        elif buffered >= chunk_size * 10:
+            while groups:
+                flush(next(iter(groups)))
+            buffered = 0
+    while groups:
+        flush(next(iter(groups)))
+    print("Messages sent, %s texts remaining." % account.texts_remaining)
+
+def send_parts(account, numbers, messages, sent_log=None):
+    """Send each of messages to numbers, returning how many were sent
+
+    Sends are recorded in sent_log, if given, and when it is set to skip
+    anyone a part was already sent to, that part is only sent to the rest.
+    """
+    if sent_log:
+        digest = sent_log.digest(messages)
+        canonical = [account.canonical_number(number) for number in numbers]
+    sent = 0
+    for part, message_part in enumerate(messages):
+        pending = numbers
+        if sent_log and sent_log.skip:
+            pending = [number for number, key in zip(numbers, canonical)
+                       if not sent_log.was_sent(digest, part, key)]
+            if len(pending) < len(numbers):
+                log.info('Skipping %d recipients already sent part %d',
+                        len(numbers) - len(pending), part + 1)
+            if not pending:
+                sent += 1
+                continue
+        if account.send(pending, message_part):
+            sent += 1
+            if sent_log:
+                sent_log.add(digest, part, [account.canonical_number(number)
+                                            for number in pending])
+    return sent
+
+def send_queued(account, queue, results=None, scheduling=True):
+    """Send everything in the queue, waiting for retries to become due
+
+    With scheduling, the schedules are sent as they come due too, for as
+    long as there are any.
+    """
+    if account.login():
+        print("Logged in")
+    else:
+        raise LoginException("Could not login.")
+
+    print("Sending queued texts...")
+    while True:
+        if scheduling:
+            queue.fire()
+        message, sends = queue.next_due(chunk_size)
+        if not sends:
+            delay = queue.wait(scheduling)
+            if delay is None:
+                return
+            log.info('Waiting %d seconds for the next send', delay)
+            time.sleep(delay)
+            continue
+        ids = [send_id for send_id, number in sends]
+        numbers = [number for send_id, number in sends]
+
+        # Log in again if the session has expired
+        if not account.login():
+            queue.release(ids)
+            raise LoginException("Could not login.")
+        if account.texts_remaining < len(numbers):
+            queue.release(ids)
+            if not (scheduling and queue.timers):
+                raise LoginException("You don't have enough texts remaining.")
+            # Keep the schedules going until the allowance is renewed
+            log.warning("Not enough texts remaining, checking again in %d "
+                    "seconds", account.quota_recheck_interval)
+            time.sleep(account.quota_recheck_interval)
+            continue
+        try:
+            sent = account.send(numbers, message)
+            error = 'Message not sent'
+        except (HTTPError, URLError, LoginException) as err:
+            log.warning(err)
+            sent, error = False, err
+        if sent:
+            queue.sent(ids)
             print("Message sent, %s texts remaining." % account.texts_remaining)
+            write_results(results, numbers, 'sent')
+        else:
+            failed = queue.failed(ids, error)
+            write_results(results, [number for send_id, number in sends
+                                    if send_id in failed], 'failed', error)
+
+def login_pool(credentials):
+    """Log in to every account concurrently, returning those with texts left"""
+    pool = []
+    def login(account_carrier, account_username, account_password):
+        account = get_account(account_carrier, account_username,
+                account_password)
+        try:
+            if not account.login():
+                log.error("Could not login to %s", account_username)
+            elif account.texts_remaining <= 0:
+                log.error("No texts remaining for %s", account_username)
+            else:
+                pool.append(account)
+        except (HTTPError, URLError, LoginException) as err:
+            log.error("Could not login to %s: %s", account_username, err)
+        except Exception:
+            log.exception("Could not login to %s", account_username)
+
+    # Each account only needs logging in (and a worker) once
+    unique = []
+    for credential in credentials:
+        if credential not in unique:
+            unique.append(credential)
+    threads = [threading.Thread(target=login, args=credential)
+               for credential in unique]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    print("%d of %d accounts logged in" % (len(pool), len(unique)))
+    return pool
+
+def send_pool(pool, recipients, message, results=None, sent_log=None):
+    """Send message to recipients using several logged in accounts at once
+
+    Each recipient is routed to the best account for it (see Router) and
+    each account is given its own worker thread, which sends to the
+    recipients routed to it a chunk at a time. Returns the number of
+    recipients that could not be sent to because no account had any texts
+    left.
+    """
+    messages = dict((account, split_message(message, account.message_length))
+                    for account in pool)
+    router = Router(pool, recipients,
+                    dict((account, len(messages[account])) for account in pool),
+                    results)
+
+    def worker(account):
+        while True:
+            numbers = router.next_chunk(account)
+            if numbers is None:
+                return
+            sent = 0
+            try:
+                # Log in again if the session has expired
+                if not account.login():
+                    raise LoginException("Could not login.")
+                sent = send_parts(account, numbers, messages[account], sent_log)
+            except (HTTPError, URLError, LoginException) as err:
+                # Hand the chunk to the other accounts and retire this one
+                log.error("Sending from %s failed: %s", account.username, err)
+                router.retire(account, numbers)
+                return
+            finally:
+                router.done(account, numbers)
+            if sent == len(messages[account]):
+                write_results(results, numbers, 'sent', account.username)
+            else:
+                write_results(results, numbers, 'failed', '%s: %d of %d parts '
+                        'sent' % (account.username, sent, len(messages[account])))
+
+    threads = [threading.Thread(target=worker, args=(account,))
+               for account in pool]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    router.close()
+    for account in pool:
+        print("%s: %s texts remaining" % (account.username,
+                account.texts_remaining))
+    log.info('Routed %s', ', '.join('%d to %s' % (count, account.username)
+             for account, count in router.routed.items()))
+    return router.unsent
+
+def serve(address, send):
+    """Accept messages to send over HTTP until interrupted
+
+    address is either host:port to listen on or the path of a Unix socket.
+    Messages are queued and sent one at a time with send(recipients, message,
+    results), which keeps using the same logged in accounts.
+    """
+    signal.signal(signal.SIGTERM, signal_handler)
+    try:
+        from http.server import BaseHTTPRequestHandler
+    except ImportError:
+        from BaseHTTPServer import BaseHTTPRequestHandler
+    class handler(SendRequestHandler, BaseHTTPRequestHandler):
+        pass
+    if ':' in address:
+        host, port = address.rsplit(':', 1)
+        server = SendServer((host or 'localhost', int(port)), handler)
+    else:
+        # Only a socket left by an earlier run is removed, never another file
+        import stat
+        if os.path.exists(address):
+            if not stat.S_ISSOCK(os.stat(address).st_mode):
+                log.error("%s exists and isn't a socket", address)
+                return 1
+            os.remove(address)
+        server = UnixSendServer(address, handler)
+    server.jobs = SendJobs(send)
+    server.jobs.start()
+    print("Listening on %s" % address)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+def pipe(send, output, input=None):
+    """Send each message read from input (stdin) as soon as it arrives
+
+    Messages are lines of JSON, as posted to /send in server mode, optionally
+    with an id. The outcome of each is written to output as a line of JSON
+    once it has been sent, and nothing is prompted for.
+    """
+    signal.signal(signal.SIGTERM, signal_handler)
+    input = input or sys.stdin
+    for line_number, line in enumerate(iter(input.readline, ''), 1):
+        if not line.strip():
+            continue
+        outcome = {'id': line_number}
+        results = StringIO()
+        try:
+            request = json.loads(line)
+            if isinstance(request, dict):
+                outcome['id'] = request.get('id', line_number)
+            recipients, message = parse_send_request(request)
+            send(iter(recipients), message, results)
+            outcome['state'] = 'done'
+        except ValueError as err:
+            outcome.update(state='invalid', error=str(err))
+        except (HTTPError, URLError, LoginException) as err:
+            log.error('Sending message %s failed: %s', outcome['id'], err)
+            outcome.update(state='failed', error=str(err))
+        except Exception as err:
+            # Carry on with the messages that follow whatever went wrong
+            log.exception('Sending message %s failed', outcome['id'])
+            outcome.update(state='failed', error=str(err))
+        outcome['results'] = read_results(results)
+        output.write(json.dumps(outcome) + '\n')
+        output.flush()
+
+def parse_send_request(request):
+    """Return the recipients and message of a request decoded from JSON
+
+    Raises ValueError if it isn't an object with a message and recipients, or
+    names an unknown alias.
+    """
+    try:
+        recipients = request['recipients']
+        message = request['message']
+    except (KeyError, TypeError):
+        raise ValueError('Expected a JSON object with message and recipients')
+    if not isinstance(recipients, list):
+        recipients = [recipients]
+    if not isinstance(message, string_types) or not all(
+            isinstance(recipient, string_types) for recipient in recipients):
+        raise ValueError('The message and recipients must be strings')
+    recipients = list(expand_recipients(recipients))
+    if not recipients or not message.strip():
+        raise ValueError('No message or recipients')
+    return recipients, message
+
+def read_results(results):
+    """Return the outcomes written to the StringIO results as dicts"""
+    return [dict(zip(('recipient', 'status', 'detail'), line.split('\t')))
+            for line in results.getvalue().splitlines()]
+
+def start_stub_carriers(latency=0, failure_rate=0):
+    """Send everything to stub carriers running in this process
+
+    Sessions, texts remaining, the sent log and the default queue are kept in
+    a temporary directory so that those of the real accounts are left alone.
+    """
+    global __cookie_file__, __queue_file__, quota_ledger, sent_log
+    server = SendServer(('127.0.0.1', 0), stub_handler())
+    server.latency = latency or 0
+    server.failure_rate = failure_rate or 0
+    server.texts_remaining = {}
+    server.meteor_recipients = {}
+    server.lock = threading.Lock()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    connection_pool.stub = server.server_address
+
+    import atexit, shutil, tempfile
+    state_dir = tempfile.mkdtemp(prefix='cliresms-dry-run-')
+    atexit.register(shutil.rmtree, state_dir, True)
+    __cookie_file__ = os.path.join(state_dir, 'cookie')
+    __queue_file__ = os.path.join(state_dir, 'queue')
+    quota_ledger = QuotaLedger(os.path.join(state_dir, 'quota'))
+    sent_log = SentLog(os.path.join(state_dir, 'sent'))
+    print("Dry run: sending to stub carriers on port %d" % server.server_address[1])
+    return server
+
+def stub_handler():
+    try:
+        from http.server import BaseHTTPRequestHandler
+    except ImportError:
+        from BaseHTTPServer import BaseHTTPRequestHandler
+    class handler(StubCarrierHandler, BaseHTTPRequestHandler):
+        def handle(self):
+            try:
+                BaseHTTPRequestHandler.handle(self)
+            except socket.error:
+                # Clients dropping idle keep-alive connections
+                pass
+    return handler
 
 def setup_parser():
     parser = argparse.ArgumentParser(prog='cliresms',
         description='Send webtexts from the command line')
     parser.add_argument('recipients', metavar='<number|alias|group>',
-        nargs='+',
+        nargs='*',
         help='One or more numbers or entries in the config file')
+    parser.add_argument('-f', '--recipients-file', metavar='FILE',
+            type=argparse.FileType('r'),
+            help='Also send to each number or alias listed in this file, one '
+            'per line or as the first column of a CSV file (- for stdin)')
+    parser.add_argument('-T', '--template', action='store_true',
+            help='Fill in the {fields} of the message for each recipient, '
+            'with their number, name and the columns of the recipients file')
+    parser.add_argument('-o', '--results', metavar='FILE',
+            type=argparse.FileType('w'), dest='results_file',
+            help='Write the outcome for each recipient to this file')
+    parser.add_argument('--chunk-size', metavar='N', type=int,
+            help='Send to at most this many recipients per request '
+            '(defaults to %d)' % chunk_size)
     parser.add_argument('-u', '--username', metavar='STRING',
             help='Use this username (defaults to unix username)')
     parser.add_argument('-p', '--password', metavar='STRING',
@@ -315,8 +1372,53 @@ def setup_parser():
             'default, overrides config file nosplit)')
     parser.add_argument('-C', '--carrier', metavar='NAME',
             help="Force the carrier to be this (``meteor'', ``o2'' or ``three''")
+    parser.add_argument('-P', '--pool', action='store_true',
+            help='Send using all the accounts defined in the config file at '
+            'once, sharing the recipients out between them')
     parser.add_argument('-m', '--message', metavar='STRING',
             help="Don't wait for STDIN, send this message")
+    parser.add_argument('--serve', metavar='ADDRESS',
+            help='Stay logged in and send the messages submitted over HTTP '
+            'to ADDRESS, either host:port or the path of a Unix socket')
+    parser.add_argument('--pipe', action='store_true',
+            help='Send messages read from stdin as lines of JSON, writing the '
+            'outcome of each to stdout as a line of JSON, without prompting')
+    parser.add_argument('-q', '--queue', metavar='FILE',
+            help='Keep texts to send in this database, retrying any that '
+            'fail and resuming where a previous run stopped')
+    parser.add_argument('--at', metavar='TIME', type=parse_time,
+            help='Queue the message to be sent at TIME: HH:MM, YYYY-MM-DD '
+            'HH:MM or +INTERVAL from now, e.g. +30m')
+    parser.add_argument('--every', metavar='INTERVAL', type=parse_interval,
+            help='Queue the message to be sent every INTERVAL, e.g. 12h or '
+            '1d, from --at or now, staying logged in to send it')
+    parser.add_argument('--schedules', action='store_true',
+            help='List the messages scheduled with --every and exit')
+    parser.add_argument('--cancel-schedule', metavar='ID', type=int,
+            help='Cancel the schedule with this ID, as listed by --schedules, '
+            'and exit')
+    parser.add_argument('--skip-sent', action='store_true',
+            help="Don't send to anyone the message was already sent to in "
+            "the last day, e.g. when sending again after being interrupted")
+    parser.add_argument('-t', '--timeout', metavar='SECONDS', type=float,
+            help='Give up on requests to the carrier after this long '
+            '(defaults to 30)')
+    parser.add_argument('-n', '--dry-run', action='store_true',
+            help="Don't send anything, go through the motions with stub "
+            "carriers instead")
+    parser.add_argument('--stub-latency', metavar='SECONDS', type=float,
+            help='Delay each response from the stub carriers this long')
+    parser.add_argument('--stub-failures', metavar='RATE', type=float,
+            help='Have this fraction of requests to the stub carriers fail')
+    parser.add_argument('--stats', action='store_true',
+            help='Show a summary of the requests made to the carriers')
+    parser.add_argument('--metrics', metavar='FILE',
+            help='Write metrics for the requests made to the carriers to '
+            'FILE in the Prometheus text format')
+    parser.add_argument('--trace', metavar='FILE',
+            type=argparse.FileType('w'),
+            help='Write each request made to the carriers to FILE as a '
+            'line of JSON')
     parser.add_argument('-v', '--verbose', action='count', default=0)
     parser.add_argument('--version', action='version',
         version='%(prog)s ' + __version__)
@@ -328,72 +1430,241 @@ def signal_handler(signum, frame):
 
 class Account(object):
     message_length = 480
-
-    def __init__(self, username, password):
+    # Seconds to trust the count of texts remaining kept locally before
+    # checking it with the carrier again
+    quota_sync_interval = 60 * 60
+    # Seconds between checks with the carrier while there are no texts left,
+    # in case the allowance has been renewed
+    quota_recheck_interval = 60
+    # Seconds a session lasts if the carrier doesn't say, and how long before
+    # a session expires to start a new one
+    session_lifetime = 30 * 60
+    session_refresh = 60
+    number_separators_re = re.compile(r'[\s\-\.]')
+    number_invalid_re = re.compile(r'[^\d\+]')
+    # Numbers without a country code are taken to be in this country
+    country_code = '353'
+    # Prefixes of the numbers the carrier gave out
+    network_prefixes = ()
+    # Bytes of a page read at a time when scanning it, how much of the end of
+    # what has been read to keep for matches that straddle two reads, and how
+    # much more of the page to read after a match so that the connection can
+    # be used again rather than closed
+    scan_chunk_size = 8192
+    scan_overlap = 512
+    scan_drain = 64 * 1024
+
+    def __init__(self, username, password, cookie_file=__cookie_file__):
+        load_http()
         self.username = username
         self.password = password
-        self.cj = cookiejar.MozillaCookieJar(__cookie_file__)
+        self.cj = cookiejar.MozillaCookieJar(cookie_file)
         self._texts_remaining = None
-
-        opener = build_opener(HTTPCookieProcessor(self.cj))
-        install_opener(opener)
+        # When the texts remaining were last checked with the carrier
+        self.quota_synced = 0
+        self.requests = 0
+        self.session_expires = None
+
+        # Each account has its own opener (and so cookie jar) so that several
+        # accounts can be logged in at once, but they share connections
+        self.opener = build_opener(HTTPCookieProcessor(self.cj),
+                KeepAliveHandler(connection_pool))
+
+    def urlopen(self, url, data=None, operation='request'):
+        """Open url, recording the request in metrics under operation"""
+        self.requests += 1
+        if data is None and isinstance(url, Request):
+            data = url.data
+        record = metrics.start(self, operation, len(data or b''))
+        try:
+            response = self.opener.open(url, data)
+        except HTTPError as err:
+            metrics.finish(record, err.code, error=True)
+            if err.code in (401, 403):
+                self.invalidate()
+            raise
+        except URLError:
+            metrics.finish(record, None, error=True)
+            raise
+        metrics.track(record, response)
+        # Being sent back to the login page means the session has expired
+        if self.session_expires and self.login_url in response.geturl():
+            self.invalidate()
+            raise LoginException("Session expired.")
+        return response
+
+    def scan(self, response, pattern):
+        """Return the match of pattern in the response, or None
+
+        The page is read a chunk at a time and only the end of it is kept, and
+        reading stops as soon as there's a match. A match running up to the
+        end of what has been read isn't taken until there's more, as it might
+        go on further.
+        """
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        content = ''
+        try:
+            while True:
+                data = response.read(self.scan_chunk_size)
+                content += decoder.decode(data, not data)
+                match = re.search(pattern, content)
+                if match and (match.end() < len(content) or not data):
+                    break
+                if not data:
+                    return None
+                keep = len(content) - self.scan_overlap
+                if match:
+                    keep = min(keep, match.start())
+                content = content[max(keep, 0):]
+            # Finish reading a page that's nearly done with, to keep the
+            # connection, otherwise give up on it
+            drained = 0
+            while data and drained < self.scan_drain:
+                data = response.read(self.scan_chunk_size)
+                drained += len(data)
+            return match
+        finally:
+            response.close()
+
+    def logged_in(self):
+        """Return whether the session is good for a while yet"""
+        return (self.session_expires is not None and
+                time.time() < self.session_expires - self.session_refresh)
 
     def login(self, request=None):
+        # The session from an earlier login is still valid
+        if self.logged_in():
+            return True
+
         print("Logging in...", end='')
         sys.stdout.flush()
         # Valid cookies found in cookie file, no need to login
-        if os.path.isfile(__cookie_file__):
+        if self.session_expires is None and os.path.isfile(self.cj.filename):
             try:
                 self.cj.load()
             except cookiejar.LoadError:
                 log.exception('Error loading cookie file, try to delete '
-                    '%s', __cookie_file__)
+                    '%s', self.cj.filename)
                 raise
             for c in self.cj:
-                if c.name in self.cookies['session']:
-                    print("(using existing session)", end=' ')
-                    sys.stdout.flush()
-                    return True
-
+                if c.name == self.cookies['session'] and c.expires:
+                    self.session_expires = c.expires
+                    if self.logged_in():
+                        print("(using existing session)", end=' ')
+                        sys.stdout.flush()
+                        return True
+
+        # Start a new session
+        self.session_expires = None
+        self.cj.clear()
         if request:
-            response = urlopen(request)
+            response = self.urlopen(request, operation='login')
         else:
             data = urlencode(self.login_form_data).encode('utf-8')
-            response = urlopen(self.login_url, data)
+            response = self.urlopen(self.login_url, data, 'login')
+        # Read the response so that the connection can be reused
+        response.read()
 
         if self.loggedin_url in response.geturl():
             self.save_cookies()
             return True
 
     def save_cookies(self):
-        # Adjust session cookie to expire after 30 minutes from now
+        # Keep the session cookie until it expires, or for the session
+        # lifetime if the carrier didn't give it an expiry
         for c in self.cj:
             if c.name == self.cookies['session']: login_cookie = c
         login_cookie.discard = False
-        future = datetime.datetime.now() + datetime.timedelta(minutes=30)
-        unix_time = int(time.mktime(future.timetuple()))
-        login_cookie.expires = unix_time
+        if not login_cookie.expires:
+            login_cookie.expires = int(time.time() + self.session_lifetime)
+        self.session_expires = login_cookie.expires
+        self.cj.save()
+
+    def invalidate(self):
+        """Forget the session, e.g. because the carrier has rejected it"""
+        self.session_expires = None
+        self.cj.clear()
         self.cj.save()
 
     def validate_number(self, recipient):
         # Remove whitespace, hyphens and dots
-        recipient = re.sub(r'[\s\-\.]', '', recipient)
+        recipient = self.number_separators_re.sub('', recipient)
 
         # Contains letters or other invalid characters
-        if re.search(r'[^\d\+]', recipient):
-            raise ValueError("Number contains invalid characters. Only a + and \
-                    digits are allowed.")
+        if self.number_invalid_re.search(recipient):
+            raise ValueError("%s contains invalid characters. Only a + and "
+                    "digits are allowed." % recipient)
         return recipient
 
+    def on_network(self, number):
+        """Return whether a number in international form is on this network
+
+        Numbers may have been moved to another network, so this is only a
+        guess from their prefix.
+        """
+        return any(number.startswith('+' + self.country_code + prefix[1:])
+                   for prefix in self.network_prefixes)
+
+    def canonical_number(self, number):
+        """Return a valid number in international form, e.g. +353861234567"""
+        if number.startswith('+'):
+            return number
+        if number.startswith('00'):
+            return '+' + number[2:]
+        if number.startswith('0'):
+            return '+' + self.country_code + number[1:]
+        return number
+
+    def send(self, recipients, message):
+        """Send message to recipients, keeping count of the texts remaining
+
+        Waits first if sending now would go over the rate limits for the
+        carrier or the account.
+        """
+        for name in (self.carrier_name(), self.ledger_key):
+            if name in rate_limits:
+                rate_limits[name].acquire()
+        if self.send_message(recipients, message):
+            self.texts_remaining -= len(recipients)
+            return True
+        # The count may be wrong, e.g. if texts were sent elsewhere
+        self.sync_texts_remaining()
+        return False
+
     @property
     def texts_remaining(self):
-        if not self._texts_remaining:
-            self._texts_remaining = self._get_texts_remaining()
+        # Use the count kept from previous runs unless it is out of date or
+        # has run out, in which case the allowance may have been renewed
+        if self._texts_remaining is None:
+            entry = quota_ledger.get(self.ledger_key)
+            if entry and entry['remaining'] > 0:
+                self._texts_remaining = entry['remaining']
+                self.quota_synced = entry['synced']
+        age = time.time() - self.quota_synced
+        if (self._texts_remaining is None or age >= self.quota_sync_interval or
+                (self._texts_remaining <= 0 and
+                 age >= self.quota_recheck_interval)):
+            self.sync_texts_remaining()
         return self._texts_remaining
 
     @texts_remaining.setter
     def texts_remaining(self, value):
         self._texts_remaining = value
+        if value >= 0:
+            quota_ledger.update(self.ledger_key, value)
+
+    def sync_texts_remaining(self):
+        """Get the texts remaining from the carrier"""
+        self.quota_synced = time.time()
+        self._texts_remaining = self._get_texts_remaining()
+        if self._texts_remaining >= 0:
+            quota_ledger.update(self.ledger_key, self._texts_remaining,
+                    time.time())
+        return self._texts_remaining
+
+    @property
+    def ledger_key(self):
+        return '%s:%s' % (self.carrier_name(), self.username)
 
     @classmethod
     def carrier_name(cls):
@@ -404,8 +1675,15 @@ class Account(object):
             return match.group(1).lower()
 
 class MeteorAccount(Account):
-    def __init__(self, username, password):
-        super(MeteorAccount, self).__init__(username, password)
+    network_prefixes = ('085',)
+    # Number of recipients added per request when sending
+    add_batch_size = 25
+    # Prefixes replaced by 0 to give the national number format
+    international_prefixes = ('+353', '00353')
+    valid_number_re = re.compile(r'08[0-9]\d{7}')
+
+    def __init__(self, username, password, *args, **kwargs):
+        super(MeteorAccount, self).__init__(username, password, *args, **kwargs)
 
         self.cookies = {'login': "MyMeteorCMS-cookie",
                         'session': "JSESSIONID",}
@@ -420,21 +1698,22 @@ class MeteorAccount(Account):
         url = 'https://www.mymeteor.ie/go/freewebtext'
         pat = r'Free web texts left <input type="text" id="numfreesmstext" value="(\d+)" disabled size=2>'
 
-        response = urlopen(url)
-        response_data = response.read().decode('utf-8')
-        match = re.search(pat, response_data)
-        log.debug('Texts remaining page:\n%s', response_data)
+        response = self.urlopen(url, operation='quota')
+        match = self.scan(response, pat)
         self.texts_remaining = int(match.group(1) if match else -1)
-        return self.texts_remaining
+        return self._texts_remaining
 
     def validate_number(self, recipient):
         recipient = super(MeteorAccount, self).validate_number(recipient)
 
         # Convert to national number format
-        recipient = re.sub(r'(\+353|00353)', '0', recipient)
+        for prefix in self.international_prefixes:
+            if recipient.startswith(prefix):
+                recipient = '0' + recipient[len(prefix):]
+                break
 
         # Valid Irish number
-        if re.search(r'^08[0-9]\d{7}', recipient):
+        if self.valid_number_re.match(recipient):
             return recipient
         raise ValueError("%s is invalid; expected 10 digits beginning with 08"
                 % recipient)
@@ -442,16 +1721,21 @@ class MeteorAccount(Account):
     def send_message(self, recipients, message):
         url = 'https://www.mymeteor.ie/mymeteorapi/index.cfm'
         pat = r'showEl\("sentTrue"\)'
+        requests = self.requests
 
-        for recipient in recipients:
-            # Add recipient
-            data = {'event': 'smsAjax',
-                    'func': 'addEnteredMsisdns',
-                    'ajaxRequest': 'addEnteredMSISDNs',
-                    'remove': '-',
-                    'add': '0|' + recipient,}
-            params = urlencode(data)#.encode('utf-8')
-            urlopen(url + '?' + params)
+        # Add recipients several at a time, falling back to adding them one
+        # by one if the carrier rejects a batch
+        for i in range(0, len(recipients), self.add_batch_size):
+            batch = recipients[i:i + self.add_batch_size]
+            try:
+                self._add_recipients(url, batch)
+            except HTTPError as err:
+                if len(batch) == 1:
+                    raise
+                log.info('Adding %d recipients at once failed (%s), adding '
+                         'them individually', len(batch), err)
+                for recipient in batch:
+                    self._add_recipients(url, [recipient])
 
         # Add message
         data = {'event': 'smsAjax',
@@ -459,12 +1743,26 @@ class MeteorAccount(Account):
                 'ajaxRequest': 'sendSMS',
                 'messageText': message,}
         params = urlencode(data)#.encode('utf-8')
-        response = urlopen(url + '?' + params)
-        if re.search(pat, response.read().decode('utf-8')): return True
+        response = self.urlopen(url + '?' + params, operation='send')
+        log.info('Sent to %d recipients in %d requests', len(recipients),
+                 self.requests - requests)
+        if self.scan(response, pat): return True
+
+    def _add_recipients(self, url, recipients):
+        data = {'event': 'smsAjax',
+                'func': 'addEnteredMsisdns',
+                'ajaxRequest': 'addEnteredMSISDNs',
+                'remove': '-',
+                'add': ','.join('0|' + recipient for recipient in recipients),}
+        params = urlencode(data)#.encode('utf-8')
+        # Read the response so that the connection can be reused
+        self.urlopen(url + '?' + params, operation='add').read()
 
 class ThreeAccount(Account):
-    def __init__(self, username, password):
-        super(ThreeAccount, self).__init__(username, password)
+    network_prefixes = ('083',)
+
+    def __init__(self, username, password, *args, **kwargs):
+        super(ThreeAccount, self).__init__(username, password, *args, **kwargs)
 
         self.cookies = {'login': "CAKEPHP",
                         'session': "AWSELB",}
@@ -477,10 +1775,10 @@ class ThreeAccount(Account):
         url = self.loggedin_url
         pat = r'Remaining texts\D*(\d+) \(of (\d+)\)'
 
-        response = urlopen(url)
-        match = re.search(pat, response.read().decode('utf-8'))
+        response = self.urlopen(url, operation='quota')
+        match = self.scan(response, pat)
         self.texts_remaining = int(match.group(1) if match else -1)
-        return self.texts_remaining
+        return self._texts_remaining
 
     def send_message(self, recipients, message):
         url = self.loggedin_url
@@ -489,8 +1787,8 @@ class ThreeAccount(Account):
                 'data[Message][recipients_individual]': ', '.join(recipients), }
 
         data = urlencode(data).encode('utf-8')
-        response = urlopen(url, data)
-        if re.search(pat, response.read().decode('utf-8')):
+        response = self.urlopen(url, data, 'send')
+        if self.scan(response, pat):
             return True
 
     def save_cookies(self):
@@ -499,13 +1797,27 @@ class ThreeAccount(Account):
             if c.name == self.cookies['login']: login_cookie = c
             if c.name == self.cookies['session']: session_cookie = c
         session_cookie.discard = False
+        # Or for the session lifetime if the carrier didn't give an expiry
+        if not login_cookie.expires:
+            login_cookie.expires = int(time.time() + self.session_lifetime)
         session_cookie.expires = login_cookie.expires
+        self.session_expires = login_cookie.expires
         self.cj.save()
 
 class O2Account(Account):
-    def __init__(self, username, account):
-        super(O2Account, self).__init__(username, password)
-
+    network_prefixes = ('086',)
+    # Strings, single quoted strings, bare keys, then comments and multipliers
+    js_token_re = re.compile(r'''("(?:[^"\\]|\\.)*")
+                             |'((?:[^'\\]|\\.)*)'
+                             |(?<![\w$])([A-Za-z_$][\w$]*)(?=\s*:)
+                             |/\*.*?\*/|//[^\n]*
+                             |[^\S\n]*\*[^\S\n]*\d+''', re.DOTALL | re.VERBOSE)
+    js_escape_re = re.compile(r'\\.|"', re.DOTALL)
+
+    def __init__(self, username, password, *args, **kwargs):
+        super(O2Account, self).__init__(username, password, *args, **kwargs)
+
+        self.sid = None
         self.cookies = {'session': "iPlanetDirectoryPro",}
         self.login_url = "https://www.o2online.ie/amserver/UI/Login"
         self.loggedin_url = "http://www.o2online.ie/wps/wcm/connect/O2/Logged+in/LoginCheck"
@@ -521,14 +1833,18 @@ class O2Account(Account):
         request = Request(self.login_url, data)
         request.add_header('Referer', self.loggedin_url)
         if Account.login(self, request):
-            return self.find_sid()
+            return self.sid is not None or self.find_sid()
+
+    def invalidate(self):
+        super(O2Account, self).invalidate()
+        self.sid = None
 
     def find_sid(self):
         url = "http://messaging.o2online.ie/ssomanager.osp?APIID=AUTH-WEBSSO&TargetApp=o2om_smscenter_new.osp%3FMsgContentID%3D-1%26SID%3D_"
         pat = r'o2om_smscenter_new.osp\?MsgContentID=-1&SID=_&SID=(\w+)'
 
-        response = urlopen(url)
-        match = re.search(pat, response.read().decode('utf-8'))
+        response = self.urlopen(url, operation='login')
+        match = self.scan(response, pat)
         if match:
             self.sid = match.group(1)
             return True
@@ -539,7 +1855,7 @@ class O2Account(Account):
         #data = {'MsgContentID': '-1',
         #        'SID': self.sid, }
         # data = urlencode(data).encode('utf-8')
-        #response = urlopen(url, data)
+        #response = self.urlopen(url, data)
         #match = re.search(pat, response.read().decode('utf-8'))
         #self.texts_remaining = int(match.group(1) if match else -1)
         #return self.texts_remaining
@@ -550,55 +1866,1169 @@ class O2Account(Account):
                 'FID': '6406',}
         data = urlencode(data).encode('utf-8')
         request = Request(url, data)
-        request.add_header('Referer', request.get_origin_req_host())
-        response = urlopen(request)
+        request.add_header('Referer', request.origin_req_host)
+        response = self.urlopen(request, operation='quota')
         try:
             content = self.parse_json(response.read().decode('utf-8'))
         except ValueError:
             content = None
         self.texts_remaining = content['freeMessageCount'] if content else -1
-        return self.texts_remaining
+        return self._texts_remaining
 
     def send_message(self, recipients, message):
         url = "http://messaging.o2online.ie/smscenter_send.osp"
         data = {'SID': self.sid,
                 'MsgContentID': '-1',
-                'SMSTo': ', '.join(recipient),
+                'SMSTo': ', '.join(recipients),
                 'SMSText': message, }
         data = urlencode(data).encode('utf-8')
         request = Request(url, data)
-        request.add_header('Referer', request.get_origin_req_host())
-        response = urlopen(request)
+        request.add_header('Referer', request.origin_req_host)
+        response = self.urlopen(request, operation='send')
         content = self.parse_json(response.read().decode('utf-8'))
         return content['isSuccess']
 
     def parse_json(self, content):
-        # Find and strip out comments
-        comment_re = re.compile(
-                '(^)?[^\S\n]*/(?:\*(.*?)\*/[^\S\n]*|/[^\n]*)($)?',
-                re.DOTALL | re.MULTILINE
-        )
-        match = comment_re.search(content)
-        while match:
-            content = content[:match.start()] + content[match.end():]
-            match = comment_re.search(content)
-
-        # Fix malformed parts
-        content = re.sub('\'', '"', content)
-        #content = re.sub('[\n\r\t]', '', content)
-        content = re.sub(' \* \d*,', ',', content)
-
-        # Surround keys in quotes
-        def quote_wrap(match):
-            offset = match.start()
-            beginning = match.group()[match.start() - offset:match.start(1) - offset]
-            ending = match.group()[match.start(1) - offset + len(match.group(1)):]
-            return beginning + '"' + match.group(1) + '"' + ending
-        quote_re = re.compile(r'[{,][\n\r\t]*\s*(\w+)\s*:')
-        return json.loads(quote_re.sub(quote_wrap, content))
+        """Parse one of O2's responses, which are JavaScript objects
+
+        Everything is fixed up in one pass over the response: comments and
+        multipliers (as in 160 * 3) are dropped, single quoted strings are
+        double quoted and bare keys are quoted.
+        """
+        return json.loads(self.js_token_re.sub(self._json_token, content))
+
+    @staticmethod
+    def _json_token(match):
+        string, single_quoted, key = match.group(1, 2, 3)
+        if string is not None:
+            return string
+        if single_quoted is not None:
+            escapes = {"\\'": "'", '"': '\\"'}
+            return '"%s"' % O2Account.js_escape_re.sub(
+                    lambda m: escapes.get(m.group(), m.group()), single_quoted)
+        if key is not None:
+            return '"%s"' % key
+        return ''
 
 class LoginException(Exception):
     pass
 
+class ConnectionPool(object):
+    """Keep-alive HTTP(S) connections shared by all accounts
+
+    Idle connections are kept per host, at most size of them, and handed out
+    to whichever account next makes a request to that host so that the
+    TCP and TLS handshakes are only paid once. Safe to use from several
+    threads.
+    """
+    def __init__(self, size=4, timeout=30):
+        self.size = size
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.created = 0
+        self.reused = 0
+        # (host, port) to connect to in place of every carrier, for dry runs
+        self.stub = None
+
+    def get(self, scheme, host, tunnel=None, tunnel_headers=None):
+        """Return a connection to host and whether it has been used before
+
+        With a tunnel, host is a proxy and the connection goes through it to
+        the tunnel host.
+        """
+        with self.lock:
+            idle = self.idle.get((scheme, host, tunnel))
+            if idle:
+                self.reused += 1
+                return idle.pop(), True
+            self.created += 1
+        if self.stub:
+            return HTTPConnection(*self.stub, timeout=self.timeout), False
+        if scheme == 'https':
+            conn = HTTPSConnection(host, timeout=self.timeout)
+        else:
+            conn = HTTPConnection(host, timeout=self.timeout)
+        if tunnel:
+            conn.set_tunnel(tunnel, headers=tunnel_headers)
+        return conn, False
+
+    def put(self, scheme, host, conn, tunnel=None):
+        """Return a connection, whose response has been read, for reuse"""
+        with self.lock:
+            idle = self.idle.setdefault((scheme, host, tunnel), [])
+            if len(idle) < self.size:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self.lock:
+            for idle in self.idle.values():
+                for conn in idle:
+                    conn.close()
+            self.idle.clear()
+
+    def open(self, scheme, req):
+        host = req.host if hasattr(req, 'host') else req.get_host()
+        if not host:
+            raise URLError('no host given')
+        selector = req.selector if hasattr(req, 'selector') else req.get_selector()
+        headers = dict(req.unredirected_hdrs)
+        headers.update(req.headers)
+        headers = dict((name.title(), value) for name, value in headers.items())
+        headers['Connection'] = 'keep-alive'
+        # An https request through a proxy goes through a tunnel to the
+        # carrier, set up with the proxy's credentials
+        tunnel = None if self.stub else getattr(req, '_tunnel_host', None)
+        tunnel_headers = {}
+        if tunnel and 'Proxy-Authorization' in headers:
+            tunnel_headers['Proxy-Authorization'] = headers.pop(
+                    'Proxy-Authorization')
+
+        retries = 0
+        while True:
+            conn, reused = self.get(scheme, host, tunnel, tunnel_headers)
+            try:
+                conn.request(req.get_method(), selector, req.data, headers)
+                response = conn.getresponse()
+            except socket.timeout as err:
+                # The carrier may have acted on the request already, so it
+                # mustn't be sent again
+                conn.close()
+                raise URLError(err)
+            except (socket.error, HTTPException) as err:
+                conn.close()
+                # The server may have closed an idle connection before
+                # reading the request, so try again with another one
+                if reused and self.stale(err):
+                    log.debug('Stale connection to %s: %s', host, err)
+                    retries += 1
+                    continue
+                raise URLError(err)
+            break
+
+        body = PooledResponseBody(self, scheme, host, conn, response, tunnel)
+        wrapped = addinfourl(body, response.msg, req.get_full_url(),
+                response.status)
+        wrapped.msg = response.reason
+        wrapped.retries = retries
+        return wrapped
+
+    @staticmethod
+    def stale(err):
+        """Return whether err means the connection was closed by the server
+        rather than the request failing"""
+        return (isinstance(err, BadStatusLine) or
+                getattr(err, 'errno', None) in (errno.ECONNRESET, errno.EPIPE,
+                                                errno.ECONNABORTED))
+
+    def stats(self):
+        return '%d connections opened, %d reused' % (self.created, self.reused)
+
+class PooledResponseBody(object):
+    """Response body that returns its connection to the pool once read"""
+    def __init__(self, pool, scheme, host, conn, response, tunnel=None):
+        self.pool = pool
+        self.scheme = scheme
+        self.host = host
+        self.conn = conn
+        self.response = response
+        self.tunnel = tunnel
+
+    def read(self, amt=None):
+        data = self.response.read() if amt is None else self.response.read(amt)
+        if self.response.isclosed():
+            self.release()
+        return data
+
+    def readline(self, limit=-1):
+        line = self.response.readline(limit)
+        if self.response.isclosed():
+            self.release()
+        return line
+
+    def __iter__(self):
+        return iter(self.readline, b'')
+
+    def release(self):
+        if self.conn is None:
+            return
+        if self.response.isclosed() and not self.response.will_close:
+            self.pool.put(self.scheme, self.host, self.conn, self.tunnel)
+        else:
+            # Not read to the end so the connection can't be used again
+            self.conn.close()
+        self.conn = None
+
+    def close(self):
+        self.release()
+        self.response.close()
+
+class KeepAliveHandler(object):
+    """urllib handler opening HTTP(S) requests with pooled connections
+
+    It goes before urllib's own handlers, which open a new connection for
+    every request and are left to prepare the requests.
+    """
+    handler_order = 499
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def add_parent(self, parent):
+        self.parent = parent
+
+    def close(self):
+        pass
+
+    def __lt__(self, other):
+        return self.handler_order < getattr(other, 'handler_order', 500)
+
+    def http_open(self, req):
+        return self.pool.open('http', req)
+
+    def https_open(self, req):
+        return self.pool.open('https', req)
+
+connection_pool = ConnectionPool()
+
+class QuotaLedger(object):
+    """Texts remaining for each account, kept on disk between runs"""
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.entries = None
+
+    def get(self, key):
+        with self.lock:
+            self._load()
+            return self.entries.get(key)
+
+    def update(self, key, remaining, synced=None):
+        with self.lock:
+            self._load()
+            entry = self.entries.setdefault(key, {'synced': 0})
+            entry['remaining'] = remaining
+            if synced:
+                entry['synced'] = synced
+            self._save()
+
+    def _load(self):
+        if self.entries is not None:
+            return
+        try:
+            with open(self.filename) as f:
+                self.entries = json.load(f)
+        except (IOError, ValueError):
+            self.entries = {}
+
+    def _save(self):
+        # Write to a temporary file first so the ledger is never left half
+        # written
+        tmp_filename = self.filename + '.tmp'
+        try:
+            with open(tmp_filename, 'w') as f:
+                json.dump(self.entries, f)
+            if os.path.exists(self.filename) and os.name == 'nt':
+                os.remove(self.filename)
+            os.rename(tmp_filename, self.filename)
+        except (IOError, OSError) as err:
+            log.warning('Could not save texts remaining to %s: %s',
+                    self.filename, err)
+
+quota_ledger = QuotaLedger(__quota_file__)
+
+class SentLog(object):
+    """Which parts of which messages have been sent to each number
+
+    Sends are appended to a file as they happen, so that a send can be run
+    again (e.g. after being interrupted) skipping whoever already has the
+    message. Entries older than lifetime are forgotten, so the same message
+    can be sent again another day.
+    """
+    lifetime = 24 * 60 * 60
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.sent = None
+        # Whether sends should skip numbers already sent a part
+        self.skip = False
+
+    @staticmethod
+    def digest(messages):
+        import hashlib
+        return hashlib.sha1('\0'.join(messages).encode('utf-8')).hexdigest()
+
+    def was_sent(self, digest, part, number):
+        with self.lock:
+            self._load()
+            return (digest, part, number) in self.sent
+
+    def add(self, digest, part, numbers):
+        with self.lock:
+            self._load()
+            now = int(time.time())
+            try:
+                with open(self.filename, 'a') as f:
+                    for number in numbers:
+                        f.write('%d\t%s\t%d\t%s\n' % (now, digest, part, number))
+            except IOError as err:
+                log.warning('Could not record sent texts in %s: %s',
+                        self.filename, err)
+            self.sent.update((digest, part, number) for number in numbers)
+
+    def _load(self):
+        if self.sent is not None:
+            return
+        self.sent = set()
+        current = []
+        expired = False
+        try:
+            with open(self.filename) as f:
+                for line in f:
+                    try:
+                        sent, digest, part, number = line.split()
+                        if int(sent) < time.time() - self.lifetime:
+                            expired = True
+                            continue
+                        self.sent.add((digest, int(part), number))
+                    except ValueError:
+                        continue
+                    current.append(line)
+        except IOError:
+            return
+        if expired:
+            # Drop the old entries so the file doesn't keep growing
+            tmp_filename = self.filename + '.tmp'
+            try:
+                with open(tmp_filename, 'w') as f:
+                    f.writelines(current)
+                if os.name == 'nt':
+                    os.remove(self.filename)
+                os.rename(tmp_filename, self.filename)
+            except (IOError, OSError) as err:
+                log.warning('Could not save %s: %s', self.filename, err)
+
+sent_log = SentLog(__sent_file__)
+
+class TokenBucket(object):
+    """Rate limit of rate sends per second, allowing bursts of up to burst
+
+    Callers reserve a token and sleep until it is due, so waiting senders are
+    let through in turn at the steady rate. Safe to use from several threads.
+    """
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.time()
+        self.lock = threading.Lock()
+        self.waiting = 0
+        self.waited = 0.0
+
+    def acquire(self):
+        """Wait until a send is allowed, returning how long that took"""
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst,
+                    self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+            if delay:
+                self.waiting += 1
+                self.waited += delay
+        if delay:
+            log.debug('Rate limited, waiting %.1f seconds', delay)
+            time.sleep(delay)
+            with self.lock:
+                self.waiting -= 1
+        return delay
+
+def rate_stats():
+    return ', '.join('%s: %d waiting, %.1f seconds waited' %
+            (name, bucket.waiting, bucket.waited)
+            for name, bucket in sorted(rate_limits.items()))
+
+class Metrics(object):
+    """Latency, size, status and retries of every request to the carriers
+
+    Requests are summed up for each carrier and operation (login, quota, add
+    or send) and, if trace is a file, also written to it one JSON object per
+    line as their responses are read. Percentiles of the latency are taken
+    over the last window requests, so a long running server keeps a bounded
+    amount.
+    """
+    window = 1000
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.trace = None
+
+    def start(self, account, operation, sent):
+        return {'time': time.time(), 'carrier': account.carrier_name(),
+                'account': account.username, 'operation': operation,
+                'bytes_sent': sent, 'bytes_received': 0, 'retries': 0}
+
+    def track(self, record, response):
+        """Record a response, counting its body as it is read"""
+        record['retries'] = getattr(response, 'retries', 0)
+        self.finish(record, response.getcode(), traced=False)
+        read = response.read
+        def counted_read(*args):
+            data = read(*args)
+            self.received(record, len(data))
+            if not args or not data:
+                self.write_trace(record)
+            return data
+        response.read = counted_read
+        # A page closed before it's all read is traced as it stands
+        close = response.close
+        def traced_close():
+            close()
+            self.write_trace(record)
+        response.close = traced_close
+
+    def finish(self, record, status, error=False, traced=True):
+        record['latency'] = time.time() - record['time']
+        record['status'] = status
+        record['error'] = error
+        with self.lock:
+            stats = self.stats.get((record['carrier'], record['operation']))
+            if not stats:
+                stats = self.stats[record['carrier'], record['operation']] = {
+                    'latencies': collections.deque(maxlen=self.window),
+                    'requests': 0, 'latency_sum': 0, 'latency_max': 0,
+                    'statuses': collections.Counter(), 'errors': 0,
+                    'bytes_sent': 0, 'bytes_received': 0, 'retries': 0}
+            stats['latencies'].append(record['latency'])
+            stats['requests'] += 1
+            stats['latency_sum'] += record['latency']
+            stats['latency_max'] = max(stats['latency_max'],
+                                       record['latency'])
+            stats['statuses'][str(status)] += 1
+            stats['errors'] += error
+            stats['bytes_sent'] += record['bytes_sent']
+            stats['retries'] += record['retries']
+        if traced:
+            self.write_trace(record)
+
+    def received(self, record, size):
+        record['bytes_received'] += size
+        with self.lock:
+            self.stats[record['carrier'], record['operation']][
+                    'bytes_received'] += size
+
+    def write_trace(self, record):
+        if self.trace and not record.get('traced'):
+            record['traced'] = True
+            line = json.dumps(dict((key, value) for key, value
+                                   in record.items() if key != 'traced'),
+                              sort_keys=True)
+            with self.lock:
+                self.trace.write(line + '\n')
+                self.trace.flush()
+
+    def summary(self):
+        """Return a table of the requests made, by carrier and operation"""
+        lines = ['%-8s %-9s %8s %6s %9s %9s %9s %9s %9s %7s' % ('carrier',
+                'operation', 'requests', 'errors', 'p50 ms', 'p95 ms',
+                'max ms', 'KB sent', 'KB recv', 'retries')]
+        with self.lock:
+            for (carrier_name, operation), stats in sorted(self.stats.items()):
+                latencies = sorted(stats['latencies'])
+                lines.append('%-8s %-9s %8d %6d %9.1f %9.1f %9.1f %9.1f %9.1f '
+                        '%7d' % (carrier_name, operation, stats['requests'],
+                        stats['errors'], percentile(latencies, 50) * 1000,
+                        percentile(latencies, 95) * 1000,
+                        stats['latency_max'] * 1000,
+                        stats['bytes_sent'] / 1024.0,
+                        stats['bytes_received'] / 1024.0, stats['retries']))
+        return '\n'.join(lines)
+
+    def prometheus(self):
+        """Return the metrics in Prometheus' text exposition format"""
+        lines = []
+        def metric(name, kind, help):
+            lines.append('# HELP cliresms_%s %s' % (name, help))
+            lines.append('# TYPE cliresms_%s %s' % (name, kind))
+        with self.lock:
+            stats = sorted(self.stats.items())
+            metric('requests_total', 'counter', 'Requests to the carriers')
+            for (carrier_name, operation), entry in stats:
+                for status, count in sorted(entry['statuses'].items()):
+                    lines.append('cliresms_requests_total{carrier="%s",'
+                            'operation="%s",status="%s"} %d'
+                            % (carrier_name, operation, status, count))
+            metric('request_seconds', 'summary',
+                    'Time until the response to each request')
+            for (carrier_name, operation), entry in stats:
+                labels = 'carrier="%s",operation="%s"' % (carrier_name,
+                                                          operation)
+                latencies = sorted(entry['latencies'])
+                for quantile in (0.5, 0.95, 0.99):
+                    lines.append('cliresms_request_seconds{%s,quantile="%s"} '
+                            '%f' % (labels, quantile,
+                            percentile(latencies, quantile * 100)))
+                lines.append('cliresms_request_seconds_sum{%s} %f'
+                        % (labels, entry['latency_sum']))
+                lines.append('cliresms_request_seconds_count{%s} %d'
+                        % (labels, entry['requests']))
+            for name, help in (('errors', 'Requests that failed'),
+                               ('bytes_sent', 'Bytes of request bodies'),
+                               ('bytes_received', 'Bytes of response bodies'),
+                               ('retries', 'Requests retried on a new '
+                                           'connection')):
+                metric(name + '_total', 'counter', help)
+                for (carrier_name, operation), entry in stats:
+                    lines.append('cliresms_%s_total{carrier="%s",'
+                            'operation="%s"} %d' % (name, carrier_name,
+                            operation, entry[name]))
+        return '\n'.join(lines) + '\n'
+
+def percentile(values, percent):
+    """Return the percentile of the sorted values"""
+    return values[min(len(values) - 1, int(len(values) * percent / 100.0))]
+
+metrics = Metrics()
+
+class Router(object):
+    """Assigns each recipient to the account that should send to them
+
+    Recipients go to an account on their own network, where texts are
+    cheapest, if one has texts left for them, and otherwise to whichever
+    account has the most texts left. A little of the stream of recipients is
+    routed ahead of the accounts' workers, which take chunks of what has been
+    routed to them with next_chunk. Whatever an account can't send is
+    routed again to the others, so one account running out holds nothing up.
+    Safe to use from several threads.
+    """
+    def __init__(self, accounts, recipients, parts, results=None):
+        self.accounts = list(accounts)
+        self.recipients = iter(recipients)
+        # Texts it takes to send to one recipient from each account
+        self.parts = parts
+        self.results = results
+        self.seen = set()
+        self.queued = dict((account, []) for account in self.accounts)
+        # Texts needed for the recipients routed to each account but not yet
+        # sent to
+        self.planned = dict((account, 0) for account in self.accounts)
+        # The texts remaining of each account as of the last chunk it
+        # finished, so that texts being sent aren't also counted as planned
+        self.remaining = dict((account, account.texts_remaining)
+                              for account in self.accounts)
+        # Recipients no account had room for, kept while texts being sent
+        # might yet fail and leave room for them
+        self.stranded = []
+        self.routed = dict((account, 0) for account in self.accounts)
+        self.active = set(self.accounts)
+        self.unsent = 0
+        self.exhausted = False
+        self.changed = threading.Condition()
+
+    def next_chunk(self, account):
+        """Return the next recipients for account, or None when there are none
+
+        Waits while the other accounts have plenty routed to them already,
+        and at the end while they might yet hand some back.
+        """
+        with self.changed:
+            queue = self.queued[account]
+            while account in self.active:
+                while (len(queue) < chunk_size and not self.exhausted and
+                       self.backlog() < chunk_size * (len(self.active) + 1)):
+                    self.route_next()
+                if queue:
+                    chunk = queue[:chunk_size]
+                    del queue[:chunk_size]
+                    self.changed.notify_all()
+                    return chunk
+                if self.exhausted and not any(self.planned[other]
+                        for other in self.active if other is not account):
+                    break
+                self.changed.wait(1)
+            self.active.discard(account)
+            self.changed.notify_all()
+            return None
+
+    def done(self, account, numbers):
+        """Record that account has finished with numbers, sent or not"""
+        with self.changed:
+            self.planned[account] -= len(numbers) * self.parts[account]
+            self.remaining[account] = account.texts_remaining
+            stranded, self.stranded = self.stranded, []
+            for number in stranded:
+                self.route(number)
+            self.changed.notify_all()
+
+    def retire(self, account, numbers=()):
+        """Stop routing to account, routing whatever it had again"""
+        with self.changed:
+            self.active.discard(account)
+            unsent = list(numbers) + self.queued[account]
+            self.planned[account] -= len(self.queued[account]) * self.parts[account]
+            self.queued[account] = []
+            for number in unsent:
+                self.route(number)
+            self.changed.notify_all()
+
+    def close(self):
+        """Record whatever is left as unsent, once the workers are done"""
+        with self.changed:
+            self.active.clear()
+            for account, queue in self.queued.items():
+                for number in queue:
+                    self.route(number)
+                del queue[:]
+            while not self.exhausted:
+                self.route_next()
+            self.give_up(self.stranded)
+            self.stranded = []
+
+    def backlog(self):
+        return len(self.stranded) + sum(len(queue)
+                                        for queue in self.queued.values())
+
+    def capacity(self, account):
+        return self.remaining[account] - self.planned[account]
+
+    def give_up(self, recipients, detail='no texts remaining'):
+        write_results(self.results, recipients, 'unsent', detail)
+        self.unsent += len(recipients)
+
+    def route_next(self):
+        recipient = next(self.recipients, None)
+        if recipient is None:
+            self.exhausted = True
+            return
+        if self.validate(recipient):
+            self.route(recipient)
+
+    def validate(self, recipient):
+        """Return whether any account accepts recipient, and it's not a
+        duplicate"""
+        if not self.accounts:
+            # There's no one to send from, let alone check the number with
+            self.give_up([recipient], 'no accounts logged in')
+            return False
+        error = None
+        for account in self.accounts:
+            try:
+                number = account.canonical_number(
+                        account.validate_number(recipient))
+                break
+            except ValueError as err:
+                error = err
+        else:
+            log.warning(error)
+            write_results(self.results, [recipient], 'invalid', error)
+            return False
+        if number in self.seen:
+            write_results(self.results, [recipient], 'duplicate', number)
+            return False
+        self.seen.add(number)
+        return True
+
+    def route(self, recipient):
+        """Queue recipient for the best account that will take them"""
+        candidates = []
+        for account in self.active:
+            if self.capacity(account) < self.parts[account]:
+                continue
+            try:
+                number = account.validate_number(recipient)
+            except ValueError:
+                continue
+            candidates.append((
+                    account.on_network(account.canonical_number(number)),
+                    self.capacity(account), number, account))
+        if not candidates:
+            if any(self.planned[account] for account in self.active):
+                self.stranded.append(recipient)
+            else:
+                self.give_up([recipient])
+            return
+        on_network, capacity, valid, account = max(candidates,
+                key=lambda candidate: candidate[:2])
+        self.queued[account].append(valid)
+        self.planned[account] += self.parts[account]
+        self.routed[account] += 1
+
+class SendQueue(object):
+    """Texts waiting to be sent, kept in an SQLite database
+
+    Every part of a message to every recipient has its own row, so a run that
+    is interrupted can be resumed without sending anything twice. Sends that
+    fail are retried with exponential backoff, up to retries times.
+
+    Messages to be sent repeatedly are kept as schedules, which queue their
+    texts each time they fire. The next run of each is kept in a heap so
+    that only the schedules that are due are looked at.
+    """
+    retries = 5
+    backoff = 2
+    max_backoff = 300
+
+    def __init__(self, filename):
+        import sqlite3
+        self.db = sqlite3.connect(filename)
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY,
+                text TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS sends (
+                id INTEGER PRIMARY KEY,
+                message_id INTEGER NOT NULL REFERENCES messages (id),
+                recipient TEXT NOT NULL,
+                state TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt REAL NOT NULL DEFAULT 0,
+                error TEXT);
+            CREATE INDEX IF NOT EXISTS sends_due ON sends (state, next_attempt);
+            CREATE TABLE IF NOT EXISTS schedules (
+                id INTEGER PRIMARY KEY,
+                recipients TEXT NOT NULL,
+                parts TEXT NOT NULL,
+                interval REAL NOT NULL,
+                next_run REAL NOT NULL);
+        ''')
+        self.timers = self.db.execute('SELECT next_run, id FROM schedules'
+                ).fetchall()
+        heapq.heapify(self.timers)
+        # Texts being sent when the last run stopped may or may not have been
+        # delivered, so rather than risk sending them twice they are set aside
+        lost = self.db.execute("UPDATE sends SET state = 'unknown' "
+                "WHERE state = 'sending'").rowcount
+        self.db.commit()
+        if lost:
+            log.warning('%d texts were being sent when the last run stopped '
+                    'and may not have been delivered, they will not be resent',
+                    lost)
+
+    def add(self, recipients, parts, at=0):
+        """Queue each part of a message for each of recipients, due at at
+
+        Texts already queued with the same parts share their messages, so
+        those that are due together are sent together.
+        """
+        message_ids = [self.message_id(part) for part in parts]
+        for chunk in chunked(recipients, chunk_size):
+            self.db.executemany('INSERT INTO sends (message_id, recipient, '
+                    'next_attempt) VALUES (?, ?, ?)',
+                    [(message_id, recipient, at)
+                     for message_id in message_ids for recipient in chunk])
+            self.db.commit()
+
+    def message_id(self, text):
+        row = self.db.execute('SELECT id FROM messages WHERE text = ?',
+                (text,)).fetchone()
+        if row:
+            return row[0]
+        return self.db.execute('INSERT INTO messages (text) VALUES (?)',
+                               (text,)).lastrowid
+
+    def schedule(self, recipients, parts, start, interval):
+        """Queue each part of a message for each of recipients every interval
+        seconds from start"""
+        schedule_id = self.db.execute('INSERT INTO schedules (recipients, '
+                'parts, interval, next_run) VALUES (?, ?, ?, ?)',
+                (json.dumps(recipients), json.dumps(parts), interval,
+                 start)).lastrowid
+        self.db.commit()
+        heapq.heappush(self.timers, (start, schedule_id))
+
+    def fire(self):
+        """Queue the texts of every schedule that is due
+
+        Other processes may be sending from the same queue, so the schedules
+        are read again from the database and a run is only queued by
+        whichever process moves the schedule on from it.
+        """
+        now = time.time()
+        while self.timers and self.timers[0][0] <= now:
+            schedule_id = heapq.heappop(self.timers)[1]
+            row = self.db.execute('SELECT recipients, parts, interval, '
+                    'next_run FROM schedules WHERE id = ?',
+                    (schedule_id,)).fetchone()
+            if not row:
+                # Cancelled
+                continue
+            recipients, parts, interval, run = row
+            if run > now:
+                heapq.heappush(self.timers, (run, schedule_id))
+                continue
+            # Runs missed while nothing was running are skipped, and the next
+            # run is saved first so that a run is never queued twice
+            next_run = run + interval * (int((now - run) // interval) + 1)
+            moved = self.db.execute('UPDATE schedules SET next_run = ? '
+                    'WHERE id = ? AND next_run = ?',
+                    (next_run, schedule_id, run)).rowcount
+            self.db.commit()
+            heapq.heappush(self.timers, (next_run, schedule_id))
+            if moved == 1:
+                self.add(json.loads(recipients), json.loads(parts), run)
+
+    def next_due(self, limit):
+        """Return the text and (id, recipient) pairs of the next send due
+
+        The sends are marked as being sent until sent(), failed() or release()
+        is called with their ids.
+        """
+        now = time.time()
+        row = self.db.execute("SELECT message_id FROM sends WHERE state = "
+                "'pending' AND next_attempt <= ? ORDER BY id LIMIT 1",
+                (now,)).fetchone()
+        if not row:
+            return None, []
+        message_id = row[0]
+        text = self.db.execute('SELECT text FROM messages WHERE id = ?',
+                (message_id,)).fetchone()[0]
+        sends = self.db.execute("SELECT id, recipient FROM sends WHERE "
+                "message_id = ? AND state = 'pending' AND next_attempt <= ? "
+                "ORDER BY id LIMIT ?", (message_id, now, limit)).fetchall()
+        self._set_state([send_id for send_id, recipient in sends], 'sending')
+        return text, sends
+
+    def sent(self, ids):
+        self._set_state(ids, 'sent')
+
+    def release(self, ids):
+        self._set_state(ids, 'pending')
+
+    def failed(self, ids, error):
+        """Schedule the sends to be retried, returning the ids given up on"""
+        given_up = []
+        for send_id in ids:
+            attempts = self.db.execute('SELECT attempts FROM sends WHERE id = ?',
+                    (send_id,)).fetchone()[0] + 1
+            if attempts >= self.retries:
+                state = 'failed'
+                given_up.append(send_id)
+            else:
+                state = 'pending'
+            delay = min(self.backoff * 2 ** attempts, self.max_backoff)
+            self.db.execute('UPDATE sends SET state = ?, attempts = ?, '
+                    'next_attempt = ?, error = ? WHERE id = ?',
+                    (state, attempts, time.time() + delay, str(error), send_id))
+        self.db.commit()
+        return given_up
+
+    def schedules(self):
+        """Return the id, next run, interval, recipients and parts of each
+        schedule, soonest first"""
+        return [(schedule_id, next_run, interval, json.loads(recipients),
+                 json.loads(parts)) for schedule_id, next_run, interval,
+                recipients, parts in self.db.execute('SELECT id, next_run, '
+                'interval, recipients, parts FROM schedules ORDER BY next_run')]
+
+    def cancel(self, schedule_id):
+        """Remove a schedule, returning whether there was one
+
+        Texts it has already queued are still sent.
+        """
+        removed = self.db.execute('DELETE FROM schedules WHERE id = ?',
+                (schedule_id,)).rowcount
+        self.db.commit()
+        self.timers = [timer for timer in self.timers
+                       if timer[1] != schedule_id]
+        heapq.heapify(self.timers)
+        return bool(removed)
+
+    def wait(self, scheduling=True):
+        """Return the seconds until the next send, or schedule if scheduling,
+        is due, or None if there's nothing left to send"""
+        next_attempt = self.db.execute("SELECT MIN(next_attempt) FROM sends "
+                "WHERE state = 'pending'").fetchone()[0]
+        if scheduling and self.timers and (next_attempt is None or
+                            self.timers[0][0] < next_attempt):
+            next_attempt = self.timers[0][0]
+        if next_attempt is None:
+            return None
+        return max(next_attempt - time.time(), 0)
+
+    def close(self):
+        self.db.close()
+
+    def _set_state(self, ids, state):
+        self.db.executemany('UPDATE sends SET state = ? WHERE id = ?',
+                [(state, send_id) for send_id in ids])
+        self.db.commit()
+
+class SendJobs(object):
+    """Messages waiting to be sent, worked through by a background thread
+
+    The outcome of the last history messages is kept so they can be looked up
+    by id.
+    """
+    history = 1000
+
+    def __init__(self, send):
+        self.send = send
+        self.queue = Queue()
+        self.jobs = {}
+        self.finished = collections.deque()
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def start(self):
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def submit(self, recipients, message):
+        with self.lock:
+            job = {'id': next(self.ids),
+                   'state': 'queued',
+                   'recipients': recipients,
+                   'results': [],}
+            self.jobs[job['id']] = job
+        self.queue.put((job, message))
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job else None
+
+    def update(self, job, **changes):
+        with self.lock:
+            job.update(changes)
+
+    def run(self):
+        while True:
+            job, message = self.queue.get()
+            self.update(job, state='sending')
+            results = StringIO()
+            try:
+                self.send(iter(job['recipients']), message, results)
+                self.update(job, state='done')
+            except (HTTPError, URLError, LoginException) as err:
+                log.error('Sending message %d failed: %s', job['id'], err)
+                self.update(job, state='failed', error=str(err))
+            except Exception as err:
+                # Keep sending the other messages whatever went wrong
+                log.exception('Sending message %d failed', job['id'])
+                self.update(job, state='failed', error=str(err))
+            self.update(job, results=read_results(results))
+            with self.lock:
+                self.finished.append(job['id'])
+                while len(self.finished) > self.history:
+                    del self.jobs[self.finished.popleft()]
+
+class SendRequestHandler:
+    """POST /send queues a message and GET /jobs/<id> reports on it
+
+    Messages are JSON objects with the message text and a list of numbers or
+    aliases, e.g. {"message": "hi", "recipients": ["0865551234", "sean"]}.
+    This is mixed in with the standard library's BaseHTTPRequestHandler
+    when serving, so that http.server is only imported then. Like it, this
+    is an old-style class on Python 2, as the two can't be mixed otherwise.
+    """
+    def do_POST(self):
+        if self.path != '/send':
+            return self.respond(404, {'error': 'Not found'})
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length).decode('utf-8'))
+        except ValueError:
+            return self.respond(400, {'error': 'Expected a JSON object with '
+                    'message and recipients'})
+        try:
+            recipients, message = parse_send_request(request)
+        except ValueError as err:
+            return self.respond(400, {'error': str(err)})
+        job = self.server.jobs.submit(recipients, message)
+        self.respond(202, {'id': job['id'],
+                           'queued': self.server.jobs.queue.qsize()})
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            return self.respond(200, metrics.prometheus(), 'text/plain')
+        if self.path == '/status':
+            return self.respond(200, {
+                'queued': self.server.jobs.queue.qsize(),
+                'rate_limits': dict((name, {'waiting': bucket.waiting,
+                                            'waited': bucket.waited})
+                                    for name, bucket in rate_limits.items()),})
+        match = re.match(r'^/jobs/(\d+)$', self.path)
+        job = self.server.jobs.get(int(match.group(1))) if match else None
+        if not job:
+            return self.respond(404, {'error': 'Not found'})
+        self.respond(200, job)
+
+    def respond(self, code, content, content_type='application/json'):
+        if content_type == 'application/json':
+            content = json.dumps(content)
+        body = content.encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else 'local'
+
+    def log_message(self, format, *args):
+        log.info('%s %s', self.address_string(), format % args)
+
+class SendServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+class StubCarrierHandler:
+    """Imitates the carriers' websites, for dry runs and load testing
+
+    Any username and password logs in, and each account starts with
+    stub_texts texts. The server's latency and failure_rate attributes delay
+    every response and make that fraction of requests fail. Mixed in with
+    BaseHTTPRequestHandler by stub_handler, so old-style like it on Python 2.
+    """
+    stub_texts = 1000
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.handle_stub()
+
+    def do_POST(self):
+        self.handle_stub()
+
+    def handle_stub(self):
+        host = self.headers.get('Host', '').split(':')[0]
+        path, _, query = self.path.partition('?')
+        length = int(self.headers.get('Content-Length', 0))
+        form = self.rfile.read(length).decode('utf-8') if length else query
+        form = dict((key, values[-1]) for key, values in parse_qs(form).items())
+        time.sleep(self.server.latency)
+        import random
+        if random.random() < self.server.failure_rate:
+            return self.respond(503, 'Service unavailable')
+        route = self.routes.get((host, path))
+        if not route:
+            return self.respond(404, 'Not found')
+        getattr(self, route)(form)
+
+    routes = {
+        ('www.mymeteor.ie', '/go/mymeteor-login-manager'): 'meteor_login',
+        ('www.mymeteor.ie', '/postpaylanding'): 'logged_in',
+        ('www.mymeteor.ie', '/go/freewebtext'): 'meteor_texts_remaining',
+        ('www.mymeteor.ie', '/mymeteorapi/index.cfm'): 'meteor_api',
+        ('webtexts.three.ie', '/webtext/users/login'): 'three_login',
+        ('webtexts.three.ie', '/webtext/messages/send'): 'three_send',
+        ('www.o2online.ie', '/amserver/UI/Login'): 'o2_login',
+        ('www.o2online.ie', '/wps/wcm/connect/O2/Logged+in/LoginCheck'): 'logged_in',
+        ('messaging.o2online.ie', '/ssomanager.osp'): 'o2_find_sid',
+        ('messaging.o2online.ie', '/smscenter_evaluate.osp'): 'o2_texts_remaining',
+        ('messaging.o2online.ie', '/smscenter_send.osp'): 'o2_send',
+    }
+
+    def session(self, name):
+        """Return the value of the session cookie, which names the account"""
+        for cookie in self.headers.get('Cookie', '').split(';'):
+            key, _, value = cookie.strip().partition('=')
+            if key == name:
+                return value
+
+    def take_texts(self, session, count=0):
+        """Use up count texts, returning the number left or None if too few"""
+        with self.server.lock:
+            remaining = self.server.texts_remaining.setdefault(session,
+                    self.stub_texts)
+            if count > remaining:
+                return None
+            self.server.texts_remaining[session] = remaining - count
+            return remaining - count
+
+    def logged_in(self, form):
+        self.respond(200, 'Welcome')
+
+    def meteor_login(self, form):
+        self.redirect('https://www.mymeteor.ie/postpaylanding',
+                ['JSESSIONID=meteor-%s; Path=/' % quote(form['username'])])
+
+    def meteor_texts_remaining(self, form):
+        self.respond(200, 'Free web texts left <input type="text" '
+                'id="numfreesmstext" value="%d" disabled size=2>'
+                % self.take_texts(self.session('JSESSIONID')))
+
+    def meteor_api(self, form):
+        session = self.session('JSESSIONID')
+        with self.server.lock:
+            added = self.server.meteor_recipients.setdefault(session, [])
+            if form.get('func') != 'sendSMS':
+                added.extend(form.get('add', '').split(','))
+                return self.respond(200, 'ok')
+            del self.server.meteor_recipients[session]
+        if self.take_texts(session, len(added)) is None:
+            return self.respond(200, 'showEl("sentFalse")')
+        self.respond(200, 'showEl("sentTrue")')
+
+    def three_login(self, form):
+        expires = time.strftime('%a, %d-%b-%Y %H:%M:%S GMT',
+                time.gmtime(time.time() + 3600))
+        self.redirect('https://webtexts.three.ie/webtext/messages/send',
+                ['CAKEPHP=stub; expires=%s; Path=/' % expires,
+                 'AWSELB=three-%s; Path=/' % quote(form['data[User][telephoneNo]'])])
+
+    def three_send(self, form):
+        session = self.session('AWSELB')
+        if self.command == 'GET':
+            return self.respond(200, 'Remaining texts: %d (of %d)' %
+                    (self.take_texts(session), self.stub_texts))
+        recipients = form.get('data[Message][recipients_individual]', '')
+        if self.take_texts(session, len(recipients.split(','))) is None:
+            return self.respond(200, 'Not enough texts')
+        self.respond(200, 'Message sent')
+
+    def o2_login(self, form):
+        self.redirect('http://www.o2online.ie/wps/wcm/connect/O2/Logged+in/LoginCheck',
+                ['iPlanetDirectoryPro=o2-%s; Domain=.o2online.ie; Path=/'
+                 % quote(form['IDToken1'])])
+
+    def o2_find_sid(self, form):
+        self.respond(200, '<a href="o2om_smscenter_new.osp?MsgContentID=-1'
+                '&SID=_&SID=stub">')
+
+    def o2_texts_remaining(self, form):
+        self.respond(200, "{freeMessageCount : %d, // free texts\n"
+                "isSuccess: true}" % self.take_texts(
+                self.session('iPlanetDirectoryPro')))
+
+    def o2_send(self, form):
+        recipients = form.get('SMSTo', '').split(',')
+        sent = self.take_texts(self.session('iPlanetDirectoryPro'),
+                len(recipients)) is not None
+        self.respond(200, "{isSuccess : %s}" % ('true' if sent else 'false'))
+
+    def redirect(self, url, cookies):
+        self.send_response(302)
+        self.send_header('Location', url)
+        for cookie in cookies:
+            self.send_header('Set-Cookie', cookie)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def respond(self, code, content):
+        body = content.encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug('Stub carrier: %s', format % args)
+
+if hasattr(socketserver, 'UnixStreamServer'):
+    class UnixSendServer(socketserver.ThreadingMixIn,
+                         socketserver.UnixStreamServer):
+        daemon_threads = True
+
 if __name__ == "__main__":
     sys.exit(main())
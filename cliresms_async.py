@@ -0,0 +1,167 @@
+# Copyright 2012 Russell Davies. Licensed under the Apache License, v2.0.
+
+"""Asyncio interface to cliresms, for Python 3.7 and later
+
+Accounts are wrapped so that logging in, checking the texts remaining and
+sending are coroutines, letting one event loop drive sends on many accounts
+at once:
+
+    account = cliresms_async.get_account('meteor', username, password)
+    if await account.login():
+        await account.send_message(['0865551234'], 'Pints?')
+
+The carriers' requests themselves are made by a transport, an executor that
+runs the blocking requests of cliresms (a pool of threads by default). Its
+size bounds how many requests are in flight across all the accounts sharing
+it.
+"""
+
+import asyncio
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+
+import cliresms
+
+# Requests in flight at once on the default transport
+concurrency = 32
+_transport = None
+
+
+def default_transport():
+    global _transport
+    if _transport is None:
+        _transport = ThreadPoolExecutor(max_workers=concurrency)
+    return _transport
+
+
+def get_account(carrier_name, username, password, transport=None):
+    """Return the account, with the session shared with cliresms.get_account"""
+    return AsyncAccount(cliresms.get_account(carrier_name, username, password),
+                        transport)
+
+
+class AsyncAccount(object):
+    """A cliresms account whose methods are coroutines
+
+    A session is a sequence of requests, so each account only runs one thing
+    at a time; other accounts carry on meanwhile.
+    """
+    def __init__(self, account, transport=None):
+        self.account = account
+        self.transport = transport or default_transport()
+        self.lock = None
+
+    @property
+    def username(self):
+        return self.account.username
+
+    async def run(self, func, *args):
+        """Run the blocking func with args on the transport"""
+        # Created here so as to belong to the running loop
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.transport, func, *args)
+
+    async def login(self):
+        return await self.run(self.account.login)
+
+    async def texts_remaining(self):
+        return await self.run(lambda: self.account.texts_remaining)
+
+    async def send_message(self, recipients, message):
+        """Send message, which must fit in one text, to valid numbers"""
+        return await self.run(self.account.send, list(recipients), message)
+
+    async def send_parts(self, numbers, messages, sent_log=None):
+        """Send each of messages to numbers, returning how many were sent"""
+        return await self.run(cliresms.send_parts, self.account, numbers,
+                              messages, sent_log)
+
+
+async def login_all(accounts):
+    """Log in to every account at once, returning those with texts left"""
+    async def login(account):
+        try:
+            if not await account.login():
+                cliresms.log.error("Could not login to %s", account.username)
+            elif await account.texts_remaining() <= 0:
+                cliresms.log.error("No texts remaining for %s",
+                                   account.username)
+            else:
+                return account
+        except (cliresms.HTTPError, cliresms.URLError,
+                cliresms.LoginException) as err:
+            cliresms.log.error("Could not login to %s: %s", account.username,
+                               err)
+        except Exception:
+            cliresms.log.exception("Could not login to %s", account.username)
+    return [account for account in
+            await asyncio.gather(*[login(account) for account in accounts])
+            if account]
+
+
+async def send(accounts, recipients, message, results=None, sent_log=None):
+    """Send message to recipients using the logged in accounts at once
+
+    Like cliresms.send_pool but without routing recipients to accounts on
+    their network: each account takes chunks of recipients from a shared
+    stream for as long as its texts remaining allow. Returns the number of
+    recipients that could not be sent to because no account had any texts
+    left.
+    """
+    chunks = cliresms.chunked(recipients, cliresms.chunk_size)
+    seen = set()
+    # Validated recipients an account took but had no texts left for
+    leftover = []
+
+    async def worker(account):
+        messages = cliresms.split_message(message,
+                                          account.account.message_length)
+        while True:
+            if leftover:
+                numbers = leftover.pop()
+            else:
+                chunk = next(chunks, None)
+                if chunk is None:
+                    return
+                numbers = list(cliresms.validate_recipients(account.account,
+                        chunk, results, seen))
+            # A negative count means it isn't known, so nothing is sent
+            capacity = max(0, await account.texts_remaining() // len(messages))
+            if capacity < len(numbers):
+                leftover.append(numbers[capacity:])
+                numbers = numbers[:capacity]
+            if capacity == 0:
+                return
+            if not numbers:
+                continue
+            try:
+                # Log in again if the session has expired
+                if not await account.login():
+                    raise cliresms.LoginException("Could not login.")
+                sent = await account.send_parts(numbers, messages, sent_log)
+            except (cliresms.HTTPError, cliresms.URLError,
+                    cliresms.LoginException) as err:
+                # Hand the chunk to the other accounts and retire this one
+                cliresms.log.error("Sending from %s failed: %s",
+                                   account.username, err)
+                leftover.append(numbers)
+                return
+            if sent == len(messages):
+                cliresms.write_results(results, numbers, 'sent',
+                                       account.username)
+            else:
+                cliresms.write_results(results, numbers, 'failed',
+                        '%s: %d of %d parts sent' % (account.username, sent,
+                                                     len(messages)))
+
+    await asyncio.gather(*[worker(account) for account in accounts])
+
+    # Whatever is left could not be sent by any account
+    unsent = 0
+    for chunk in itertools.chain(leftover, chunks):
+        cliresms.write_results(results, chunk, 'unsent', 'no texts remaining')
+        unsent += len(chunk)
+    return unsent
@@ -19,7 +19,7 @@ setup(
     author_email='russell@zeroflux.net',
     license='Apache v2',
     keywords='console cli sms webtext',
-    py_modules=['cliresms'],
+    py_modules=['cliresms', 'cliresms_async'],
     install_requires=[],
     extras_require = {
         'dev': ['check-manifest'],